@@ -3,12 +3,21 @@
 # Streamlit 1.50+
 
 import os
+import re
 import json
 import time
 import math
+import hmac
 import hashlib
 import secrets
 import sqlite3
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
 
 import pandas as pd
@@ -18,6 +27,7 @@ import pytz
 import pydeck as pdk
 import streamlit as st
 from requests.adapters import HTTPAdapter, Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from timezonefinder import TimezoneFinder
 from PIL import Image
 
@@ -211,340 +221,1040 @@ def safe_rerun():
     try: st.rerun()
     except Exception: pass
 
+class LRUCache:
+    """Thread-safe bounded LRU with hit/miss counters. Hold instances via st.cache_resource."""
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data),
+                    "maxsize": self.maxsize, "hit_rate": (self.hits / total) if total else 0.0}
+
+class RateLimiter:
+    """Spaces call starts at least `min_interval` seconds apart across threads."""
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.min_interval
+        if at > now:
+            time.sleep(at - now)
+
+class KeyedLocks:
+    """Per-key locks, created on demand and dropped once nobody holds or waits on them."""
+    def __init__(self):
+        self._mu = threading.Lock()
+        self._locks = {}  # key -> [lock, holders + waiters]
+
+    @contextmanager
+    def hold(self, *keys):
+        """Hold the locks for all `keys` (taken in sorted order, so overlapping callers can't deadlock)."""
+        keys = sorted(set(keys))
+        with self._mu:
+            entries = [self._locks.setdefault(k, [threading.Lock(), 0]) for k in keys]
+            for e in entries: e[1] += 1
+        acquired = []
+        try:
+            for e in entries:
+                e[0].acquire(); acquired.append(e)
+            yield
+        finally:
+            for e in reversed(acquired): e[0].release()
+            with self._mu:
+                for k, e in zip(keys, entries):
+                    e[1] -= 1
+                    if not e[1]: self._locks.pop(k, None)
+
+@st.cache_resource(show_spinner=False)
+def io_pool():
+    return ThreadPoolExecutor(max_workers=int(os.getenv("APP_IO_WORKERS", "4")), thread_name_prefix="hp-io")
+
+def submit_io(fn, *args, **kwargs):
+    ctx = get_script_run_ctx()
+    def run():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return io_pool().submit(run)
+
 # =========================
 # DB (SQLite) + Presets
 # =========================
 DB_PATH = os.getenv("APP_DB_PATH", "data.db")
 os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
 
-def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+DB_POOL_SIZE = int(os.getenv("APP_DB_POOL_SIZE", "8"))
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-16000;
+PRAGMA mmap_size=134217728;
+PRAGMA temp_store=MEMORY;
+PRAGMA busy_timeout=5000;
+"""
+
+def db(path=None):
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False, timeout=5.0)
     conn.row_factory = sqlite3.Row
+    conn.executescript(DB_PRAGMAS)
     return conn
 
+class ConnectionPool:
+    """Reuses configured SQLite connections across reruns and threads (one user at a time)."""
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try: conn = self._idle.get_nowait()
+        except queue.Empty: conn = db(self.path)
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction: conn.rollback()
+            if self._idle.qsize() < self.size: self._idle.put(conn)
+            else: conn.close()
+
+@st.cache_resource(show_spinner=False)
+def db_pool(path=DB_PATH):
+    return ConnectionPool(path)
+
+@contextmanager
+def db_read():
+    with db_pool(DB_PATH).connection() as conn:
+        yield conn.cursor()
+
+@contextmanager
+def db_tx():
+    with db_pool(DB_PATH).connection() as conn:
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 def now_iso():
     return datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
 
-def init_db():
-    conn = db()
-    cur = conn.cursor()
-    cur.executescript("""
-    PRAGMA journal_mode=WAL;
-    CREATE TABLE IF NOT EXISTS users(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      username TEXT UNIQUE NOT NULL,
-      email TEXT UNIQUE,
-      pw_hash TEXT NOT NULL,
-      salt TEXT NOT NULL,
-      bio TEXT,
-      sensitivities TEXT,
-      activities TEXT,
-      created_at TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS groups(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      name TEXT NOT NULL,
-      description TEXT,
-      city TEXT,
-      tags TEXT,
-      owner_id INTEGER NOT NULL,
-      visibility TEXT DEFAULT 'public',
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(owner_id) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS group_members(
-      group_id INTEGER NOT NULL,
-      user_id INTEGER NOT NULL,
-      role TEXT DEFAULT 'member',
-      joined_at TEXT NOT NULL,
-      PRIMARY KEY(group_id,user_id),
-      FOREIGN KEY(group_id) REFERENCES groups(id),
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS outings(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      group_id INTEGER NOT NULL,
-      title TEXT NOT NULL,
-      time_utc TEXT NOT NULL,
-      location_name TEXT,
-      lat REAL, lon REAL,
-      max_people INTEGER,
-      notes TEXT,
-      created_by INTEGER NOT NULL,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(group_id) REFERENCES groups(id),
-      FOREIGN KEY(created_by) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS rsvps(
-      outing_id INTEGER NOT NULL,
-      user_id INTEGER NOT NULL,
-      status TEXT NOT NULL,
-      responded_at TEXT NOT NULL,
-      PRIMARY KEY(outing_id,user_id),
-      FOREIGN KEY(outing_id) REFERENCES outings(id),
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS posts(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      group_id INTEGER NOT NULL,
-      user_id INTEGER NOT NULL,
-      body TEXT NOT NULL,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(group_id) REFERENCES groups(id),
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS comments(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      post_id INTEGER NOT NULL,
-      user_id INTEGER NOT NULL,
-      body TEXT NOT NULL,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(post_id) REFERENCES posts(id),
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    CREATE TABLE IF NOT EXISTS presets(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user_id INTEGER NOT NULL,
-      name TEXT NOT NULL,
-      payload TEXT NOT NULL,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    """)
-    conn.commit()
-    conn.close()
+# Full-text indexes: external-content FTS5 tables over the searchable columns, kept in sync by triggers.
+# fts table -> (content table, indexed columns, bm25 column weights)
+FTS_INDEXES = {
+    "groups_fts": ("groups", ("name", "description", "city", "tags"), (10.0, 2.0, 6.0, 4.0)),
+    "posts_fts": ("posts", ("body",), (1.0,)),
+    "outings_fts": ("outings", ("title", "location_name", "notes"), (8.0, 4.0, 1.0)),
+}
+
+def fts5_available(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def _create_fts_indexes(conn):
+    # Builds without FTS5 skip this and search falls back to LIKE; init_db retries via ensure_fts_indexes
+    if not fts5_available(conn):
+        return
+    for fts, (table, cols, _) in FTS_INDEXES.items():
+        c = ", ".join(cols); new = ", ".join(f"new.{x}" for x in cols); old = ", ".join(f"old.{x}" for x in cols)
+        conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({c}, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN INSERT INTO {fts}(rowid, {c}) VALUES (new.id, {new}); END")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN INSERT INTO {fts}({fts}, rowid, {c}) VALUES ('delete', old.id, {old}); END")
+        # UPDATE OF the indexed columns only, so RSVP counter updates on outings don't touch the index
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {c} ON {table} BEGIN
+            INSERT INTO {fts}({fts}, rowid, {c}) VALUES ('delete', old.id, {old});
+            INSERT INTO {fts}(rowid, {c}) VALUES (new.id, {new}); END""")
+        conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+def _fts_missing(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='groups_fts'").fetchone() is None
+
+def ensure_fts_indexes(conn):
+    """Build the indexes v4 skipped, once this SQLite build has FTS5; the write lock is only taken when needed."""
+    if not _fts_missing(conn) or not fts5_available(conn):
+        return
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if _fts_missing(conn): _create_fts_indexes(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Each step is a single SQL statement or a callable taking the connection.
+MIGRATIONS = [
+    (1, [  # baseline schema (IF NOT EXISTS keeps it safe on pre-migration databases)
+        """
+        CREATE TABLE IF NOT EXISTS users(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          username TEXT UNIQUE NOT NULL,
+          email TEXT UNIQUE,
+          pw_hash TEXT NOT NULL,
+          salt TEXT NOT NULL,
+          bio TEXT,
+          sensitivities TEXT,
+          activities TEXT,
+          created_at TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS groups(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          name TEXT NOT NULL,
+          description TEXT,
+          city TEXT,
+          tags TEXT,
+          owner_id INTEGER NOT NULL,
+          visibility TEXT DEFAULT 'public',
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(owner_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS group_members(
+          group_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          role TEXT DEFAULT 'member',
+          joined_at TEXT NOT NULL,
+          PRIMARY KEY(group_id,user_id),
+          FOREIGN KEY(group_id) REFERENCES groups(id),
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS outings(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          group_id INTEGER NOT NULL,
+          title TEXT NOT NULL,
+          time_utc TEXT NOT NULL,
+          location_name TEXT,
+          lat REAL, lon REAL,
+          max_people INTEGER,
+          notes TEXT,
+          created_by INTEGER NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(group_id) REFERENCES groups(id),
+          FOREIGN KEY(created_by) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rsvps(
+          outing_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          status TEXT NOT NULL,
+          responded_at TEXT NOT NULL,
+          PRIMARY KEY(outing_id,user_id),
+          FOREIGN KEY(outing_id) REFERENCES outings(id),
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS posts(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          group_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          body TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(group_id) REFERENCES groups(id),
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS comments(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          post_id INTEGER NOT NULL,
+          user_id INTEGER NOT NULL,
+          body TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(post_id) REFERENCES posts(id),
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS presets(
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          name TEXT NOT NULL,
+          payload TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(user_id) REFERENCES users(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS osm_tiles(
+          z INTEGER NOT NULL,
+          x INTEGER NOT NULL,
+          y INTEGER NOT NULL,
+          fetched_at REAL NOT NULL,
+          PRIMARY KEY(z,x,y)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS osm_tile_elements(
+          z INTEGER NOT NULL,
+          x INTEGER NOT NULL,
+          y INTEGER NOT NULL,
+          layer TEXT NOT NULL,
+          osm_type TEXT NOT NULL,
+          osm_id INTEGER NOT NULL,
+          lat REAL NOT NULL,
+          lon REAL NOT NULL,
+          tags TEXT NOT NULL,
+          PRIMARY KEY(z,x,y,layer,osm_type,osm_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS geocode_cache(
+          qkey TEXT PRIMARY KEY,
+          found INTEGER NOT NULL,
+          lat REAL,
+          lon REAL,
+          display_name TEXT,
+          fetched_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (2, [  # secondary indexes for the community queries
+        "CREATE INDEX IF NOT EXISTS idx_outings_group_time ON outings(group_id, time_utc)",
+        "CREATE INDEX IF NOT EXISTS idx_outings_time ON outings(time_utc)",
+        "CREATE INDEX IF NOT EXISTS idx_posts_group_created ON posts(group_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments(post_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members(user_id, group_id)",
+        "CREATE INDEX IF NOT EXISTS idx_presets_user_created ON presets(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_groups_created ON groups(created_at)",
+    ]),
+    (3, [  # denormalised RSVP counters on outings, maintained by triggers on rsvps
+        "ALTER TABLE outings ADD COLUMN going_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE outings ADD COLUMN maybe_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE outings ADD COLUMN not_going_count INTEGER NOT NULL DEFAULT 0",
+        """
+        UPDATE outings SET
+          going_count = (SELECT COUNT(*) FROM rsvps r WHERE r.outing_id=outings.id AND r.status='going'),
+          maybe_count = (SELECT COUNT(*) FROM rsvps r WHERE r.outing_id=outings.id AND r.status='maybe'),
+          not_going_count = (SELECT COUNT(*) FROM rsvps r WHERE r.outing_id=outings.id AND r.status='not_going')
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS rsvps_count_ai AFTER INSERT ON rsvps BEGIN
+          UPDATE outings SET
+            going_count = going_count + (NEW.status='going'),
+            maybe_count = maybe_count + (NEW.status='maybe'),
+            not_going_count = not_going_count + (NEW.status='not_going')
+          WHERE id=NEW.outing_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS rsvps_count_ad AFTER DELETE ON rsvps BEGIN
+          UPDATE outings SET
+            going_count = going_count - (OLD.status='going'),
+            maybe_count = maybe_count - (OLD.status='maybe'),
+            not_going_count = not_going_count - (OLD.status='not_going')
+          WHERE id=OLD.outing_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS rsvps_count_au AFTER UPDATE OF status, outing_id ON rsvps BEGIN
+          UPDATE outings SET
+            going_count = going_count - (OLD.status='going'),
+            maybe_count = maybe_count - (OLD.status='maybe'),
+            not_going_count = not_going_count - (OLD.status='not_going')
+          WHERE id=OLD.outing_id;
+          UPDATE outings SET
+            going_count = going_count + (NEW.status='going'),
+            maybe_count = maybe_count + (NEW.status='maybe'),
+            not_going_count = not_going_count + (NEW.status='not_going')
+          WHERE id=NEW.outing_id;
+        END
+        """,
+    ]),
+    (4, [_create_fts_indexes]),  # full-text search over groups, posts and outings
+    (5, [  # OneCall forecasts shared by every search in the same grid cell
+        """
+        CREATE TABLE IF NOT EXISTS forecast_cells(
+          cell TEXT PRIMARY KEY,
+          lat REAL NOT NULL,
+          lon REAL NOT NULL,
+          issued_at REAL,
+          fetched_at REAL NOT NULL,
+          payload TEXT NOT NULL
+        )
+        """,
+    ]),
+    (6, [  # per-user default location for Explore's cold start
+        "ALTER TABLE users ADD COLUMN last_address TEXT",
+    ]),
+]
+
+def migrate_db(conn):
+    """Bring `conn` up to the latest schema version; each version runs in its own IMMEDIATE transaction."""
+    conn.isolation_level = None
+    # Plain read first: at the latest version no write lock is taken, so a busy writer can't fail startup.
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= MIGRATIONS[-1][0]:
+        return MIGRATIONS[-1][0]
+    for version, steps in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.execute("COMMIT")
+                continue
+            for step in steps:
+                if callable(step): step(conn)
+                else: conn.execute(step)
+            conn.execute(f"PRAGMA user_version={int(version)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+@st.cache_resource(show_spinner=False)
+def init_db(path=DB_PATH):
+    """Migrate once per process; reruns hit the cache (failures aren't cached, so they retry)."""
+    conn = db(path)
+    try:
+        version = migrate_db(conn)
+        ensure_fts_indexes(conn)  # before fts_enabled() caches its answer for the process
+        return version
+    finally: conn.close()
+
+# =========================
+# Auth service
+# =========================
+# Stored hashes are self-describing: "pbkdf2_sha256$<iters>$<hex>" or "scrypt$<n>$<r>$<p>$<hex>" (salt stays
+# in users.salt). Bare hex is the original format: PBKDF2-SHA256 at 100k iterations.
+# A successful login re-hashes whenever the stored scheme/work factor differs from the configured one.
+PW_SCHEME = os.getenv("APP_PW_SCHEME", "pbkdf2_sha256")  # or "scrypt"
+PW_PBKDF2_ITERS = int(os.getenv("APP_PW_PBKDF2_ITERS", "100000"))
+PW_SCRYPT_PARAMS = tuple(int(x) for x in os.getenv("APP_PW_SCRYPT_PARAMS", "16384,8,1").split(","))  # n, r, p
+LEGACY_PBKDF2_ITERS = 100_000
+AUTH_WORKERS = int(os.getenv("APP_AUTH_WORKERS", "2"))  # 0 hashes on the calling thread
+AUTH_TIMEOUT_S = 30
+# (max failures, window seconds) before further attempts are refused without hashing
+AUTH_USER_LIMIT = (5, 15 * 60)
+AUTH_IP_LIMIT = (20, 15 * 60)
+# Behind a reverse proxy st.context.ip_address is the proxy's own address, which would turn the IP window into
+# one global limit. Name the header the proxy sets (e.g. "X-Forwarded-For"); its last entry is used, being the
+# one the nearest proxy appended. Only set this when a proxy is in front, since clients can forge the header.
+AUTH_CLIENT_IP_HEADER = os.getenv("APP_CLIENT_IP_HEADER", "")
+
+class AuthRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many attempts; retry in {int(retry_after)}s")
+        self.retry_after = retry_after
+
+class AuthBusy(Exception):
+    """The hashing pool didn't get to the request within AUTH_TIMEOUT_S."""
+
+class FailureWindow:
+    """Sliding-window failure counter per key ((username, IP) pair / client IP)."""
+    def __init__(self, limit, window_s):
+        self.limit, self.window_s = limit, window_s
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + window_s
+
+    def retry_after(self, key):
+        """Seconds until `key` may try again (0 when allowed)."""
+        if key is None: return 0
+        now = time.monotonic()
+        with self._lock:
+            q = self._hits.get(key)
+            while q and now - q[0] > self.window_s:
+                q.popleft()
+            if q is not None and not q:
+                del self._hits[key]
+            return self.window_s - (now - q[0]) if q and len(q) >= self.limit else 0
+
+    def fail(self, key):
+        if key is None: return
+        now = time.monotonic()
+        with self._lock:
+            self._hits.setdefault(key, deque()).append(now)
+            if now >= self._next_sweep:  # keys that never come back would otherwise stay forever
+                self._hits = {k: q for k, q in self._hits.items() if now - q[-1] <= self.window_s}
+                self._next_sweep = now + self.window_s
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)
+
+@st.cache_resource
+def auth_limiters():
+    return FailureWindow(*AUTH_USER_LIMIT), FailureWindow(*AUTH_IP_LIMIT)
+
+@st.cache_resource
+def auth_pool():
+    # Hashing is CPU-bound: a bounded process pool queues login bursts instead of stalling script threads.
+    # fork, not spawn: Streamlit installs the script as __main__, so spawned workers would re-run the app.
+    # Where fork is unavailable use threads (hashlib releases the GIL while deriving).
+    if AUTH_WORKERS <= 0: return None
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="hp-auth")
+    return ProcessPoolExecutor(max_workers=AUTH_WORKERS, mp_context=multiprocessing.get_context("fork"))
+
+def _derive(password, salt_hex, scheme, params):
+    pw, salt = password.encode("utf-8"), bytes.fromhex(salt_hex)
+    if scheme == "scrypt":
+        n, r, p = params
+        fn, args, kwargs = hashlib.scrypt, (pw,), dict(salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20), dklen=32)
+    else:
+        fn, args, kwargs = hashlib.pbkdf2_hmac, ("sha256", pw, salt, params[0]), {}
+    pool = auth_pool()
+    if pool is not None:
+        fut = None
+        try:
+            fut = pool.submit(fn, *args, **kwargs)
+            return fut.result(timeout=AUTH_TIMEOUT_S)
+        except FutureTimeout:
+            fut.cancel()  # drop it from the queue if no worker picked it up yet
+            raise AuthBusy()
+        except BrokenProcessPool:
+            auth_pool.clear()
+    return fn(*args, **kwargs)
+
+def _parse_pw_hash(stored):
+    parts = stored.split("$")
+    if len(parts) == 1:
+        return "pbkdf2_sha256", (LEGACY_PBKDF2_ITERS,), stored
+    return parts[0], tuple(int(x) for x in parts[1:-1]), parts[-1]
+
+def _configured_scheme():
+    return ("scrypt", PW_SCRYPT_PARAMS) if PW_SCHEME == "scrypt" else ("pbkdf2_sha256", (PW_PBKDF2_ITERS,))
 
 def hash_password(password: str, salt: str|None=None):
+    """Hash with the configured scheme -> (stored_hash, salt)."""
     if not salt: salt = secrets.token_hex(16)
-    h = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), 100_000).hex()
-    return h, salt
+    scheme, params = _configured_scheme()
+    digest = _derive(password, salt, scheme, params).hex()
+    return "$".join([scheme, *map(str, params), digest]), salt
+
+def verify_password(password, stored, salt):
+    """-> (ok, needs_rehash)."""
+    scheme, params, digest = _parse_pw_hash(stored)
+    ok = hmac.compare_digest(_derive(password, salt, scheme, params).hex(), digest)
+    return ok, ok and (scheme, params) != _configured_scheme()
+
+def client_ip():
+    try:
+        if AUTH_CLIENT_IP_HEADER:
+            forwarded = st.context.headers.get(AUTH_CLIENT_IP_HEADER)
+            if forwarded: return forwarded.split(",")[-1].strip() or None
+        return st.context.ip_address
+    except Exception: return None
 
 def create_user(username, email, password):
-    conn = db(); cur = conn.cursor()
     pw_hash, salt = hash_password(password)
-    cur.execute("INSERT INTO users (username,email,pw_hash,salt,bio,sensitivities,activities,created_at) VALUES (?,?,?,?,?,?,?,?)",
-                (username, email, pw_hash, salt, "", json.dumps([]), json.dumps([]), now_iso()))
-    conn.commit()
-    uid = cur.lastrowid
-    conn.close()
-    return uid
-
-def authenticate(username, password):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username=?", (username,))
-    row = cur.fetchone(); conn.close()
-    if not row: return None
-    calc,_ = hash_password(password, row["salt"])
-    return row["id"] if calc == row["pw_hash"] else None
+    with db_tx() as cur:
+        cur.execute("INSERT INTO users (username,email,pw_hash,salt,bio,sensitivities,activities,created_at) VALUES (?,?,?,?,?,?,?,?)",
+                    (username, email, pw_hash, salt, "", json.dumps([]), json.dumps([]), now_iso()))
+        return cur.lastrowid
+
+def authenticate(username, password, ip=None):
+    """User id, or None for bad credentials. Raises AuthRateLimited while the username+IP pair or the IP is throttled."""
+    by_user, by_ip = auth_limiters()
+    ukey = ((username or "").lower(), ip)  # per-pair, so failures from elsewhere can't lock the account out
+    wait = max(by_user.retry_after(ukey), by_ip.retry_after(ip))
+    if wait:
+        raise AuthRateLimited(wait)
+    with db_read() as cur:
+        cur.execute("SELECT id, pw_hash, salt FROM users WHERE username=?", (username,))
+        row = cur.fetchone()
+    ok, rehash = verify_password(password, row["pw_hash"], row["salt"]) if row else (False, False)
+    if not ok:
+        by_user.fail(ukey); by_ip.fail(ip)
+        return None
+    by_user.reset(ukey)
+    if rehash:
+        try: pw_hash, salt = hash_password(password)
+        except AuthBusy: return row["id"]  # the credentials were fine; upgrade on a later login
+        with db_tx() as cur:  # guarded on the old hash so a concurrent password change wins
+            cur.execute("UPDATE users SET pw_hash=?, salt=? WHERE id=? AND pw_hash=?", (pw_hash, salt, row["id"], row["pw_hash"]))
+    return row["id"]
 
+# =========================
+# Users + Presets
+# =========================
 def get_user(uid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id=?", (uid,))
-    row = cur.fetchone(); conn.close()
+    with db_read() as cur:
+        cur.execute("SELECT * FROM users WHERE id=?", (uid,))
+        row = cur.fetchone()
     return dict(row) if row else None
 
 def update_profile(uid, bio, sensitivities, activities):
-    conn = db(); cur = conn.cursor()
-    cur.execute("UPDATE users SET bio=?, sensitivities=?, activities=? WHERE id=?",
-                (bio, json.dumps(sensitivities), json.dumps(activities), uid))
-    conn.commit(); conn.close()
+    with db_tx() as cur:
+        cur.execute("UPDATE users SET bio=?, sensitivities=?, activities=? WHERE id=?",
+                    (bio, json.dumps(sensitivities), json.dumps(activities), uid))
+    bump_profile_version(uid)
+
+def save_last_address(uid, address):
+    with db_tx() as cur:
+        cur.execute("UPDATE users SET last_address=? WHERE id=?", (address, uid))
+
+# Per-session profile cache: st.session_state["_profile"] holds the signed-in user's public columns with
+# sensitivities/activities already parsed. A process-wide uid -> version map (bumped by update_profile)
+# invalidates it, so edits made in another session/tab are picked up on the next rerun.
+PROFILE_COLUMNS = "id, username, email, bio, sensitivities, activities, last_address, created_at"
+
+@st.cache_resource
+def profile_versions():
+    return {}, threading.Lock()
+
+def bump_profile_version(uid):
+    versions, lock = profile_versions()
+    with lock:
+        versions[uid] = versions.get(uid, 0) + 1
+
+def _json_list(raw):
+    try: v = json.loads(raw or "[]")
+    except Exception: return []
+    return v if isinstance(v, list) else []
+
+def load_user_profile(uid):
+    """Profile without credentials; sensitivities/activities parsed (lists keep stored order, *_set for lookups)."""
+    with db_read() as cur:
+        cur.execute(f"SELECT {PROFILE_COLUMNS} FROM users WHERE id=?", (uid,))
+        row = cur.fetchone()
+    if not row: return None
+    me = dict(row)
+    me["sensitivities"], me["activities"] = _json_list(me["sensitivities"]), _json_list(me["activities"])
+    me["sensitivity_set"], me["activity_set"] = frozenset(me["sensitivities"]), frozenset(me["activities"])
+    return me
+
+def current_user():
+    """Signed-in user's profile, served from the session cache unless it was invalidated."""
+    uid = st.session_state.get("user_id")
+    if uid is None:
+        return None
+    version = profile_versions()[0].get(uid, 0)
+    cached = st.session_state.get("_profile")
+    if cached and cached["id"] == uid and cached["_version"] == version:
+        return cached
+    me = load_user_profile(uid)  # version read first: a concurrent bump forces another reload
+    if me is not None:
+        me["_version"] = version
+    st.session_state["_profile"] = me
+    return me
 
 def create_preset(user_id: int, name: str, payload: dict):
-    conn = db(); cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO presets (user_id, name, payload, created_at) VALUES (?,?,?,?)",
-        (user_id, name.strip()[:120], json.dumps(payload), now_iso())
-    )
-    conn.commit()
-    pid = cur.lastrowid
-    conn.close()
-    return pid
+    with db_tx() as cur:
+        cur.execute(
+            "INSERT INTO presets (user_id, name, payload, created_at) VALUES (?,?,?,?)",
+            (user_id, name.strip()[:120], json.dumps(payload), now_iso())
+        )
+        return cur.lastrowid
 
 def list_presets(user_id: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT id, name, payload, created_at FROM presets WHERE user_id=? ORDER BY created_at DESC", (user_id,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with db_read() as cur:
+        cur.execute("SELECT id, name, payload, created_at FROM presets WHERE user_id=? ORDER BY created_at DESC", (user_id,))
+        return [dict(r) for r in cur.fetchall()]
 
 def get_preset(preset_id: int, user_id: int):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT id, name, payload FROM presets WHERE id=? AND user_id=?", (preset_id, user_id))
-    row = cur.fetchone()
-    conn.close()
+    with db_read() as cur:
+        cur.execute("SELECT id, name, payload FROM presets WHERE id=? AND user_id=?", (preset_id, user_id))
+        row = cur.fetchone()
     return dict(row) if row else None
 
 def delete_preset(preset_id: int, user_id: int) -> bool:
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM presets WHERE id=? AND user_id=?", (preset_id, user_id))
-    ok = cur.rowcount > 0
-    conn.commit(); conn.close()
-    return ok
+    with db_tx() as cur:
+        cur.execute("DELETE FROM presets WHERE id=? AND user_id=?", (preset_id, user_id))
+        return cur.rowcount > 0
 
 # =========================
 # Groups / Community
 # =========================
 def create_group(name, description, city, tags, owner_id, visibility="public"):
-    conn = db(); cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO groups (name,description,city,tags,owner_id,visibility,created_at) VALUES (?,?,?,?,?,?,?)",
-        (name, description, city, json.dumps(tags), owner_id, visibility, now_iso())
-    )
-    gid = cur.lastrowid
-    cur.execute("INSERT OR IGNORE INTO group_members (group_id,user_id,role,joined_at) VALUES (?,?,?,?)",
-                (gid, owner_id, "owner", now_iso()))
-    conn.commit(); conn.close()
+    with db_tx() as cur:
+        cur.execute(
+            "INSERT INTO groups (name,description,city,tags,owner_id,visibility,created_at) VALUES (?,?,?,?,?,?,?)",
+            (name, description, city, json.dumps(tags), owner_id, visibility, now_iso())
+        )
+        gid = cur.lastrowid
+        cur.execute("INSERT OR IGNORE INTO group_members (group_id,user_id,role,joined_at) VALUES (?,?,?,?)",
+                    (gid, owner_id, "owner", now_iso()))
     return gid
 
 def delete_group(gid, requester_id):
     g = get_group(gid)
     if not g or g["owner_id"] != requester_id:
         return False
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM comments WHERE post_id IN (SELECT id FROM posts WHERE group_id=?)", (gid,))
-    cur.execute("DELETE FROM posts WHERE group_id=?", (gid,))
-    cur.execute("DELETE FROM rsvps WHERE outing_id IN (SELECT id FROM outings WHERE group_id=?)", (gid,))
-    cur.execute("DELETE FROM outings WHERE group_id=?", (gid,))
-    cur.execute("DELETE FROM group_members WHERE group_id=?", (gid,))
-    cur.execute("DELETE FROM groups WHERE id=?", (gid,))
-    conn.commit(); conn.close()
+    with db_tx() as cur:
+        cur.execute("DELETE FROM comments WHERE post_id IN (SELECT id FROM posts WHERE group_id=?)", (gid,))
+        cur.execute("DELETE FROM posts WHERE group_id=?", (gid,))
+        cur.execute("DELETE FROM rsvps WHERE outing_id IN (SELECT id FROM outings WHERE group_id=?)", (gid,))
+        cur.execute("DELETE FROM outings WHERE group_id=?", (gid,))
+        cur.execute("DELETE FROM group_members WHERE group_id=?", (gid,))
+        cur.execute("DELETE FROM groups WHERE id=?", (gid,))
     return True
 
-def list_groups(search_city_or_name=""):
-    conn = db(); cur = conn.cursor()
-    if search_city_or_name.strip():
-        s = f"%{search_city_or_name.strip()}%"
-        cur.execute("""
-        SELECT g.*, u.username AS owner_name
-        FROM groups g JOIN users u ON u.id=g.owner_id
-        WHERE (g.city LIKE ? OR g.name LIKE ?)
-        ORDER BY g.created_at DESC
-        """, (s, s))
+@st.cache_resource
+def fts_enabled(path=DB_PATH):
+    with db_read() as cur:
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='groups_fts'")
+        return cur.fetchone() is not None
+
+def fts_match_expr(text):
+    """User text -> FTS5 query: every word must match, each as a prefix. None when there's nothing to search."""
+    words = re.findall(r"\w+", (text or "").lower())
+    return " ".join(f'"{w}"*' for w in words) or None
+
+def _fts_rank_sql(fts):
+    weights = ", ".join(str(w) for w in FTS_INDEXES[fts][2])
+    return f"SELECT rowid, bm25({fts}, {weights}) AS rank FROM {fts} WHERE {fts} MATCH ?"
+
+def search_posts(text, viewer_id, limit=20):
+    """Posts matching `text`, ranked, limited to groups the viewer belongs to (feeds are members-only)."""
+    expr = fts_match_expr(text)
+    if not expr:
+        return []
+    member = "p.group_id IN (SELECT group_id FROM group_members WHERE user_id=?)"
+    with db_read() as cur:
+        if fts_enabled():
+            cur.execute(f"""
+              SELECT p.*, u.username, g.name AS group_name, s.rank AS search_rank
+              FROM ({_fts_rank_sql("posts_fts")}) s
+              JOIN posts p ON p.id=s.rowid JOIN users u ON u.id=p.user_id JOIN groups g ON g.id=p.group_id
+              WHERE {member}
+              ORDER BY s.rank, p.id LIMIT ?
+            """, (expr, viewer_id, limit))
+        else:
+            cur.execute(f"""
+              SELECT p.*, u.username, g.name AS group_name, 0.0 AS search_rank
+              FROM posts p JOIN users u ON u.id=p.user_id JOIN groups g ON g.id=p.group_id
+              WHERE p.body LIKE ? AND {member}
+              ORDER BY p.created_at DESC LIMIT ?
+            """, (f"%{text.strip()}%", viewer_id, limit))
+        return [dict(r) for r in cur.fetchall()]
+
+def search_outings(text, upcoming_only=True, limit=20):
+    """Outings ranked by relevance across title, location and notes."""
+    expr = fts_match_expr(text)
+    if not expr:
+        return []
+    since = utc_now_bound() if upcoming_only else ""
+    with db_read() as cur:
+        if fts_enabled():
+            cur.execute(f"""
+              SELECT o.*, g.name AS group_name, s.rank AS search_rank
+              FROM ({_fts_rank_sql("outings_fts")}) s
+              JOIN outings o ON o.id=s.rowid JOIN groups g ON g.id=o.group_id
+              WHERE o.time_utc >= ?
+              ORDER BY s.rank, o.id LIMIT ?
+            """, (expr, since, limit))
+        else:
+            like = f"%{text.strip()}%"
+            cur.execute("""
+              SELECT o.*, g.name AS group_name, 0.0 AS search_rank
+              FROM outings o JOIN groups g ON g.id=o.group_id
+              WHERE (o.title LIKE ? OR o.location_name LIKE ? OR o.notes LIKE ?) AND o.time_utc >= ?
+              ORDER BY o.time_utc ASC LIMIT ?
+            """, (like, like, like, since, limit))
+        return [dict(r) for r in cur.fetchall()]
+
+def _group_search_ranked(text):
+    return bool(fts_match_expr(text)) and fts_enabled()
+
+# Keyset pagination: a cursor is the (sort key, id) of the last row of the previous page
+# (None for the first page). Pages fetch limit+1 rows to know whether another page exists.
+GROUPS_PAGE_SIZE = 24
+OUTINGS_PAGE_SIZE = 20
+POSTS_PAGE_SIZE = 20
+COMMENTS_PAGE_SIZE = 20
+
+def _keyset(col, after, desc=False, alias=""):
+    """WHERE fragment + params for rows strictly after `after` in (col, id) order."""
+    if after is None:
+        return "1=1", []
+    return f"({alias}{col}, {alias}id) {'<' if desc else '>'} (?, ?)", list(after)
+
+def _page(rows, limit, col):
+    """Trim a limit+1 fetch to `limit` rows and derive the next cursor."""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1][col], rows[-1]["id"])
+
+def list_group_cards(viewer_id, search_city_or_name="", member=None, after=None, limit=None):
+    """Group listing view: groups with owner name, member count, viewer membership and next outing, in one query.
+    `member` True/False restricts to groups the viewer is/isn't in; `after`/`limit` page via keyset.
+    A search is ranked by full-text relevance (keyset on (search_rank, id)), newest first otherwise."""
+    ranked = _group_search_ranked(search_city_or_name)
+    params, join, rank_col = [viewer_id], "", "NULL AS search_rank"
+    if ranked:
+        join, rank_col = f"JOIN ({_fts_rank_sql('groups_fts')}) s ON s.rowid=g.id", "s.rank AS search_rank"
+        params.append(fts_match_expr(search_city_or_name))
+    params.append(utc_now_bound())
+    conds = []
+    if search_city_or_name.strip() and not ranked:
+        like = f"%{search_city_or_name.strip()}%"
+        conds.append("(g.city LIKE ? OR g.name LIKE ? OR g.tags LIKE ? OR g.description LIKE ?)"); params += [like] * 4
+    if member is not None:
+        conds.append(f"{'' if member else 'NOT '}EXISTS(SELECT 1 FROM group_members mf WHERE mf.group_id=g.id AND mf.user_id=?)")
+        params.append(viewer_id)
+    if ranked:
+        ks, ks_params = ("(s.rank, g.id) > (?, ?)", list(after)) if after is not None else ("1=1", [])
+        order = "s.rank ASC, g.id ASC"
     else:
-        cur.execute("""
-        SELECT g.*, u.username AS owner_name
+        ks, ks_params = _keyset("created_at", after, desc=True, alias="g.")
+        order = "g.created_at DESC, g.id DESC"
+    conds.append(ks); params += ks_params
+    where = "WHERE " + " AND ".join(conds)
+    lim = ""
+    if limit is not None:
+        lim = "LIMIT ?"; params.append(limit)
+    with db_read() as cur:
+        cur.execute(f"""
+        SELECT g.*, u.username AS owner_name,
+          (SELECT COUNT(*) FROM group_members gm WHERE gm.group_id=g.id) AS member_count,
+          EXISTS(SELECT 1 FROM group_members me WHERE me.group_id=g.id AND me.user_id=?) AS is_member,
+          n.id AS next_id, n.title AS next_title, n.time_utc AS next_time_utc, n.location_name AS next_location_name,
+          {rank_col}
         FROM groups g JOIN users u ON u.id=g.owner_id
-        ORDER BY g.created_at DESC
-        """)
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
+        {join}
+        LEFT JOIN outings n ON n.id = (
+          SELECT o2.id FROM outings o2
+          WHERE o2.group_id=g.id AND o2.time_utc >= ?
+          ORDER BY o2.time_utc ASC, o2.id ASC LIMIT 1)
+        {where}
+        ORDER BY {order}
+        {lim}
+        """, params)
+        rows = [dict(r) for r in cur.fetchall()]
+    for r in rows:
+        r["is_member"] = bool(r["is_member"])
+        nid = r.pop("next_id")
+        nxt = {"id": nid, "title": r.pop("next_title"), "time_utc": r.pop("next_time_utc"), "location_name": r.pop("next_location_name")}
+        r["next_outing"] = nxt if nid is not None else None
     return rows
 
+def list_group_cards_page(viewer_id, search_city_or_name="", member=None, after=None, limit=GROUPS_PAGE_SIZE):
+    """One page of group cards: (rows, next_cursor)."""
+    rows = list_group_cards(viewer_id, search_city_or_name, member, after, limit + 1)
+    return _page(rows, limit, "search_rank" if _group_search_ranked(search_city_or_name) else "created_at")
+
 def get_group(gid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT g.*, u.username AS owner_name FROM groups g JOIN users u ON u.id=g.owner_id WHERE g.id=?", (gid,))
-    row = cur.fetchone(); conn.close()
+    with db_read() as cur:
+        cur.execute("SELECT g.*, u.username AS owner_name FROM groups g JOIN users u ON u.id=g.owner_id WHERE g.id=?", (gid,))
+        row = cur.fetchone()
     return dict(row) if row else None
 
 def my_groups(uid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-    SELECT g.*, u.username AS owner_name, m.role
-    FROM group_members m
-    JOIN groups g ON g.id=m.group_id
-    JOIN users u ON u.id=g.owner_id
-    WHERE m.user_id=?
-    ORDER BY g.created_at DESC
-    """, (uid,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with db_read() as cur:
+        cur.execute("""
+        SELECT g.*, u.username AS owner_name, m.role
+        FROM group_members m
+        JOIN groups g ON g.id=m.group_id
+        JOIN users u ON u.id=g.owner_id
+        WHERE m.user_id=?
+        ORDER BY g.created_at DESC
+        """, (uid,))
+        return [dict(r) for r in cur.fetchall()]
 
 def is_member(gid, uid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT 1 FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
-    ok = cur.fetchone() is not None
-    conn.close()
-    return ok
+    with db_read() as cur:
+        cur.execute("SELECT 1 FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
+        return cur.fetchone() is not None
 
 def join_group(gid, uid, role="member"):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO group_members (group_id,user_id,role,joined_at) VALUES (?,?,?,?)",
-                (gid, uid, role, now_iso()))
-    conn.commit(); conn.close()
+    with db_tx() as cur:
+        cur.execute("INSERT OR IGNORE INTO group_members (group_id,user_id,role,joined_at) VALUES (?,?,?,?)",
+                    (gid, uid, role, now_iso()))
 
 def leave_group(gid, uid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
-    conn.commit(); conn.close()
+    with db_tx() as cur:
+        cur.execute("DELETE FROM group_members WHERE group_id=? AND user_id=?", (gid, uid))
 
 def create_outing(group_id, title, time_utc, location_name, lat, lon, max_people, notes, uid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO outings (group_id,title,time_utc,location_name,lat,lon,max_people,notes,created_by,created_at)
-      VALUES (?,?,?,?,?,?,?,?,?,?)
-    """, (group_id, title, time_utc, location_name, lat, lon, max_people, notes, uid, now_iso()))
-    oid = cur.lastrowid
-    conn.commit(); conn.close()
-    return oid
+    with db_tx() as cur:
+        cur.execute("""
+          INSERT INTO outings (group_id,title,time_utc,location_name,lat,lon,max_people,notes,created_by,created_at)
+          VALUES (?,?,?,?,?,?,?,?,?,?)
+        """, (group_id, title, time_utc, location_name, lat, lon, max_people, notes, uid, now_iso()))
+        return cur.lastrowid
 
 def list_outings(group_id):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-      SELECT o.*, u.username AS creator
-      FROM outings o JOIN users u ON u.id=o.created_by
-      WHERE o.group_id=?
-      ORDER BY o.time_utc ASC
-    """, (group_id,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with db_read() as cur:
+        cur.execute("""
+          SELECT o.*, u.username AS creator
+          FROM outings o JOIN users u ON u.id=o.created_by
+          WHERE o.group_id=?
+          ORDER BY o.time_utc ASC
+        """, (group_id,))
+        return [dict(r) for r in cur.fetchall()]
+
+def list_outings_page(group_id, after=None, limit=OUTINGS_PAGE_SIZE, upcoming=True):
+    """One page of a group's outings: (rows, next_cursor). Upcoming outings soonest first,
+    or (upcoming=False) past outings most recent first."""
+    ks, ks_params = _keyset("time_utc", after, desc=not upcoming, alias="o.")
+    order = "ASC" if upcoming else "DESC"
+    with db_read() as cur:
+        cur.execute(f"""
+          SELECT o.*, u.username AS creator
+          FROM outings o JOIN users u ON u.id=o.created_by
+          WHERE o.group_id=? AND o.time_utc {'>=' if upcoming else '<'} ? AND {ks}
+          ORDER BY o.time_utc {order}, o.id {order} LIMIT ?
+        """, (group_id, utc_now_bound(), *ks_params, limit + 1))
+        return _page([dict(r) for r in cur.fetchall()], limit, "time_utc")
+
+def utc_now_bound():
+    # Same shape as stored time_utc values (UTC isoformat, no microseconds) so plain string
+    # comparison orders correctly and the (group_id, time_utc) index can be used
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+def _chunks(seq, n=500):
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+def next_outings(group_ids):
+    """Next upcoming outing for each group id in one query per 500 ids: {group_id: outing}."""
+    ids = list(dict.fromkeys(group_ids))
+    out = {}
+    bound = utc_now_bound()
+    with db_read() as cur:
+        for chunk in _chunks(ids):
+            cur.execute(f"""
+              WITH ids(gid) AS (VALUES {",".join("(?)" for _ in chunk)})
+              SELECT o.* FROM ids
+              JOIN outings o ON o.id = (
+                SELECT o2.id FROM outings o2
+                WHERE o2.group_id=ids.gid AND o2.time_utc >= ?
+                ORDER BY o2.time_utc ASC, o2.id ASC LIMIT 1)
+            """, (*chunk, bound))
+            out.update({r["group_id"]: dict(r) for r in cur.fetchall()})
+    return out
 
 def next_outing(gid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-      SELECT * FROM outings
-      WHERE group_id=? AND datetime(time_utc) >= datetime('now')
-      ORDER BY time_utc ASC LIMIT 1
-    """, (gid,))
-    row = cur.fetchone(); conn.close()
-    return dict(row) if row else None
+    return next_outings([gid]).get(gid)
 
 def rsvp(outing_id, uid, status):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO rsvps (outing_id,user_id,status,responded_at) VALUES (?,?,?,?)",
-                (outing_id, uid, status, now_iso()))
-    conn.commit(); conn.close()
+    # Upsert (not REPLACE) so the counter triggers see an UPDATE rather than a silent delete+insert
+    with db_tx() as cur:
+        cur.execute("""
+          INSERT INTO rsvps (outing_id,user_id,status,responded_at) VALUES (?,?,?,?)
+          ON CONFLICT(outing_id,user_id) DO UPDATE SET status=excluded.status, responded_at=excluded.responded_at
+        """, (outing_id, uid, status, now_iso()))
 
-def rsvp_counts(outing_id):
-    conn = db(); cur = conn.cursor()
-    cur.execute("SELECT status, COUNT(*) c FROM rsvps WHERE outing_id=? GROUP BY status", (outing_id,))
-    rows = {r["status"]: r["c"] for r in cur.fetchall()}
-    conn.close(); return rows
+def group_rsvp_summaries(group_id):
+    """Counter-backed RSVP summary for every outing of a group: {outing_id: {status: n}}."""
+    with db_read() as cur:
+        cur.execute("SELECT id, going_count, maybe_count, not_going_count FROM outings WHERE group_id=?", (group_id,))
+        return {r["id"]: {"going": r["going_count"], "maybe": r["maybe_count"], "not_going": r["not_going_count"]}
+                for r in cur.fetchall()}
 
 def create_post(gid, uid, body):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO posts (group_id,user_id,body,created_at) VALUES (?,?,?,?)",
-                (gid, uid, body, now_iso()))
-    pid = cur.lastrowid; conn.commit(); conn.close()
-    return pid
+    with db_tx() as cur:
+        cur.execute("INSERT INTO posts (group_id,user_id,body,created_at) VALUES (?,?,?,?)",
+                    (gid, uid, body, now_iso()))
+        return cur.lastrowid
 
 def list_posts(gid):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-      SELECT p.*, u.username
-      FROM posts p JOIN users u ON u.id=p.user_id
-      WHERE p.group_id=? ORDER BY p.created_at DESC
-    """, (group_id:=gid,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close(); return rows
+    with db_read() as cur:
+        cur.execute("""
+          SELECT p.*, u.username
+          FROM posts p JOIN users u ON u.id=p.user_id
+          WHERE p.group_id=? ORDER BY p.created_at DESC
+        """, (gid,))
+        return [dict(r) for r in cur.fetchall()]
+
+def list_posts_page(gid, after=None, limit=POSTS_PAGE_SIZE):
+    """Newest-first group posts, one page at a time: (rows, next_cursor)."""
+    ks, ks_params = _keyset("created_at", after, desc=True, alias="p.")
+    with db_read() as cur:
+        cur.execute(f"""
+          SELECT p.*, u.username
+          FROM posts p JOIN users u ON u.id=p.user_id
+          WHERE p.group_id=? AND {ks}
+          ORDER BY p.created_at DESC, p.id DESC LIMIT ?
+        """, (gid, *ks_params, limit + 1))
+        return _page([dict(r) for r in cur.fetchall()], limit, "created_at")
 
 def add_comment(post_id, uid, body):
-    conn = db(); cur = conn.cursor()
-    cur.execute("INSERT INTO comments (post_id,user_id,body,created_at) VALUES (?,?,?,?)",
-                (post_id, uid, body, now_iso()))
-    cid = cur.lastrowid; conn.commit(); conn.close()
-    return cid
+    with db_tx() as cur:
+        cur.execute("INSERT INTO comments (post_id,user_id,body,created_at) VALUES (?,?,?,?)",
+                    (post_id, uid, body, now_iso()))
+        return cur.lastrowid
 
 def list_comments(post_id):
-    conn = db(); cur = conn.cursor()
-    cur.execute("""
-      SELECT c.*, u.username
-      FROM comments c JOIN users u ON u.id=c.user_id
-      WHERE c.post_id=? ORDER BY c.created_at ASC
-    """, (post_id,))
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close(); return rows
+    with db_read() as cur:
+        cur.execute("""
+          SELECT c.*, u.username
+          FROM comments c JOIN users u ON u.id=c.user_id
+          WHERE c.post_id=? ORDER BY c.created_at ASC
+        """, (post_id,))
+        return [dict(r) for r in cur.fetchall()]
+
+def list_comments_page(post_id, after=None, limit=COMMENTS_PAGE_SIZE):
+    """Oldest-first replies to a post, one page at a time: (rows, next_cursor)."""
+    ks, ks_params = _keyset("created_at", after, alias="c.")
+    with db_read() as cur:
+        cur.execute(f"""
+          SELECT c.*, u.username
+          FROM comments c JOIN users u ON u.id=c.user_id
+          WHERE c.post_id=? AND {ks}
+          ORDER BY c.created_at ASC, c.id ASC LIMIT ?
+        """, (post_id, *ks_params, limit + 1))
+        return _page([dict(r) for r in cur.fetchall()], limit, "created_at")
+
+def list_comments_for_posts(post_ids, limit_per_post=None):
+    """Comments for a page of posts in one query, grouped by post: {post_id: [comment, ...]}.
+    With `limit_per_post` only the first N replies of each thread are returned."""
+    ids = list(dict.fromkeys(post_ids))
+    out = {pid: [] for pid in ids}
+    with db_read() as cur:
+        for chunk in _chunks(ids):
+            cur.execute(f"""
+              SELECT * FROM (
+                SELECT c.*, u.username,
+                  ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.created_at, c.id) AS rn
+                FROM comments c JOIN users u ON u.id=c.user_id
+                WHERE c.post_id IN ({",".join("?" for _ in chunk)}))
+              WHERE ? IS NULL OR rn <= ?
+              ORDER BY post_id, rn
+            """, (*chunk, limit_per_post, limit_per_post))
+            for r in cur.fetchall():
+                d = dict(r); d.pop("rn")
+                out[d["post_id"]].append(d)
+    return out
+
+def comment_counts(post_ids):
+    ids = list(dict.fromkeys(post_ids))
+    out = dict.fromkeys(ids, 0)
+    with db_read() as cur:
+        for chunk in _chunks(ids):
+            cur.execute(f"SELECT post_id, COUNT(*) c FROM comments WHERE post_id IN ({','.join('?' for _ in chunk)}) GROUP BY post_id", chunk)
+            out.update({r["post_id"]: r["c"] for r in cur.fetchall()})
+    return out
 
 # =========================
 # Geo / Weather helpers
@@ -557,18 +1267,89 @@ def haversine_km(lat1, lon1, lat2, lon2):
     a = (math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2)
     return 2 * R * math.asin(math.sqrt(a))
 
-@st.cache_data(show_spinner=False, ttl=3600)
+def haversine_km_vec(lat1, lon1, lat2, lon2, pairwise=False):
+    """Array haversine. With pairwise=True returns a len(1) x len(2) matrix."""
+    lat1, lon1 = np.radians(np.asarray(lat1, dtype=float)), np.radians(np.asarray(lon1, dtype=float))
+    lat2, lon2 = np.radians(np.asarray(lat2, dtype=float)), np.radians(np.asarray(lon2, dtype=float))
+    if pairwise:
+        lat1, lon1 = lat1[..., None], lon1[..., None]
+    R = 6371.0
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2 * R * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+GEOCODE_TTL_S = float(os.getenv("APP_GEOCODE_TTL_S", str(30*24*3600)))
+GEOCODE_NEG_TTL_S = float(os.getenv("APP_GEOCODE_NEG_TTL_S", str(24*3600)))
+
+def normalize_geocode_query(q):
+    # "Portland, ME", "portland me" and "Portland ME " share one key
+    return " ".join(re.sub(r"[,;.]+", " ", (q or "").lower()).split())
+
+def geocode_store_get(qkey):
+    """Returns (hit, result) from the persistent store; result None on a cached miss."""
+    with db_read() as cur:
+        cur.execute("SELECT found, lat, lon, display_name, fetched_at FROM geocode_cache WHERE qkey=?", (qkey,))
+        row = cur.fetchone()
+    if not row: return False, None
+    ttl = GEOCODE_TTL_S if row["found"] else GEOCODE_NEG_TTL_S
+    if time.time() - row["fetched_at"] > ttl: return False, None
+    if not row["found"]: return True, None
+    return True, {"lat": row["lat"], "lon": row["lon"], "display_name": row["display_name"] or ""}
+
+def geocode_store_put(qkey, loc):
+    with db_tx() as cur:
+        cur.execute("INSERT OR REPLACE INTO geocode_cache (qkey,found,lat,lon,display_name,fetched_at) VALUES (?,?,?,?,?,?)",
+                    (qkey, 1 if loc else 0, loc and loc["lat"], loc and loc["lon"], loc and loc["display_name"], time.time()))
+
 def geocode_address(q):
-    r = http().get(NOMINATIM_URL, params={"q": q, "format":"json", "limit":1}, timeout=30)
+    qkey = normalize_geocode_query(q)
+    if not qkey: return None
+    return _geocode_key(qkey)
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def _geocode_key(qkey):
+    hit, loc = geocode_store_get(qkey)
+    if hit: return loc
+    r = http().get(NOMINATIM_URL, params={"q": qkey, "format":"json", "limit":1}, timeout=30)
     r.raise_for_status()
     js = r.json()
-    if not js: return None
-    item = js[0]
-    return {"lat": float(item["lat"]), "lon": float(item["lon"]), "display_name": item.get("display_name","")}
+    loc = None
+    if js:
+        item = js[0]
+        loc = {"lat": float(item["lat"]), "lon": float(item["lon"]), "display_name": item.get("display_name","")}
+    geocode_store_put(qkey, loc)
+    return loc
+
+TZ_ROUND_DIGITS = 3  # ~100 m; keys the timezone cache
+
+@st.cache_resource(show_spinner=False)
+def tz_finder():
+    # TimezoneFinder loads its polygon data on construction; share one per process
+    return TimezoneFinder(), threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def tz_cache():
+    return LRUCache(int(os.getenv("APP_TZ_CACHE_SIZE", "20000")))
+
+def _tz_key(lat, lon):
+    return (round(float(lat), TZ_ROUND_DIGITS), round(float(lon), TZ_ROUND_DIGITS))
+
+def _tz_lookup(key):
+    tzname = tz_cache().get(key)
+    if tzname is None:
+        finder, lock = tz_finder()
+        with lock:
+            tzname = finder.timezone_at(lat=key[0], lng=key[1]) or "America/New_York"
+        tz_cache().put(key, tzname)
+    return tzname
 
 def guess_timezone(lat, lon):
-    tzname = TimezoneFinder().timezone_at(lat=lat, lng=lon)
-    return tzname or "America/New_York"
+    return _tz_lookup(_tz_key(lat, lon))
+
+def guess_timezones(coords):
+    """Batched guess_timezone; `coords` is a list of (lat, lon) or None, None entries map to None."""
+    keys = [_tz_key(*c) if c is not None else None for c in coords]
+    resolved = {k: _tz_lookup(k) for k in set(keys) if k is not None}
+    return [resolved[k] if k is not None else None for k in keys]
 
 def load_optional_keys():
     keys = {"owm": os.getenv("OWM_API_KEY")}
@@ -576,79 +1357,134 @@ def load_optional_keys():
     except Exception: pass
     return keys
 
-def build_overpass_places_query(lat, lon, radius_m):
+def overpass_area_filter(lat, lon, radius_m, bbox=None):
+    # bbox is (south, west, north, east); otherwise an `around` circle
+    if bbox is not None:
+        return "({:.6f},{:.6f},{:.6f},{:.6f})".format(*bbox)
+    return f"(around:{radius_m},{lat},{lon})"
+
+def overpass_places_union(lat, lon, radius_m, bbox=None):
     leisure = r"park|pitch|track|fitness_station|playground|sports_centre|recreation_ground|ice_rink|swimming_pool|garden"
-    q = f"""
+    area = overpass_area_filter(lat, lon, radius_m, bbox)
+    cyc = area if bbox is not None else overpass_area_filter(lat, lon, int(radius_m*0.7))
+    return f"""(
+      node["leisure"~"{leisure}"]{area};
+      way["leisure"~"{leisure}"]{area};
+      relation["leisure"~"{leisure}"]{area};
+
+      node["tourism"="beach"]{area};
+      way["tourism"="beach"]{area};
+      relation["tourism"="beach"]{area};
+
+      node["man_made"="pier"]{area};
+      way["man_made"="pier"]{area};
+      relation["man_made"="pier"]{area};
+
+      node["amenity"="community_centre"]{area};
+      way["amenity"="community_centre"]{area};
+      relation["amenity"="community_centre"]{area};
+
+      node["highway"="cycleway"]{cyc};
+      way["highway"="cycleway"]{cyc};
+      relation["highway"="cycleway"]{cyc};
+
+      node["tourism"="museum"]{area};
+      way["tourism"="museum"]{area};
+      relation["tourism"="museum"]{area};
+
+      node["amenity"="marketplace"]{area};
+      way["amenity"="marketplace"]{area};
+      relation["amenity"="marketplace"]{area};
+
+      node["amenity"="arts_centre"]{area};
+      way["amenity"="arts_centre"]{area};
+      relation["amenity"="arts_centre"]{area};
+
+      node["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"]{area};
+      way["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"]{area};
+      relation["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"]{area};
+
+      node["leisure"="garden"]["garden"~"botanical|arboretum"]{area};
+      way["leisure"="garden"]["garden"~"botanical|arboretum"]{area};
+      relation["leisure"="garden"]["garden"~"botanical|arboretum"]{area};
+      node["leisure"="garden"]["garden:type"~"botanical|arboretum"]{area};
+      way["leisure"="garden"]["garden:type"~"botanical|arboretum"]{area};
+      relation["leisure"="garden"]["garden:type"~"botanical|arboretum"]{area};
+    )"""
+
+def overpass_roads_union(lat, lon, radius_m, bbox=None):
+    hw = r"motorway|trunk|primary|secondary|motorway_link|trunk_link|primary_link|secondary_link"
+    area = overpass_area_filter(lat, lon, radius_m, bbox)
+    return f"""(
+      way["highway"~"{hw}"]{area};
+      relation["highway"~"{hw}"]{area};
+    )"""
+
+def build_overpass_places_query(lat, lon, radius_m):
+    return f"""
     [out:json][timeout:30];
-    (
-      node["leisure"~"{leisure}"](around:{radius_m},{lat},{lon});
-      way["leisure"~"{leisure}"](around:{radius_m},{lat},{lon});
-      relation["leisure"~"{leisure}"](around:{radius_m},{lat},{lon});
-
-      node["tourism"="beach"](around:{radius_m},{lat},{lon});
-      way["tourism"="beach"](around:{radius_m},{lat},{lon});
-      relation["tourism"="beach"](around:{radius_m},{lat},{lon});
-
-      node["man_made"="pier"](around:{radius_m},{lat},{lon});
-      way["man_made"="pier"](around:{radius_m},{lat},{lon});
-      relation["man_made"="pier"](around:{radius_m},{lat},{lon});
-
-      node["amenity"="community_centre"](around:{radius_m},{lat},{lon});
-      way["amenity"="community_centre"](around:{radius_m},{lat},{lon});
-      relation["amenity"="community_centre"](around:{radius_m},{lat},{lon});
-
-      node["highway"="cycleway"](around:{int(radius_m*0.7)},{lat},{lon});
-      way["highway"="cycleway"](around:{int(radius_m*0.7)},{lat},{lon});
-      relation["highway"="cycleway"](around:{int(radius_m*0.7)},{lat},{lon});
-
-      node["tourism"="museum"](around:{radius_m},{lat},{lon});
-      way["tourism"="museum"](around:{radius_m},{lat},{lon});
-      relation["tourism"="museum"](around:{radius_m},{lat},{lon});
-
-      node["amenity"="marketplace"](around:{radius_m},{lat},{lon});
-      way["amenity"="marketplace"](around:{radius_m},{lat},{lon});
-      relation["amenity"="marketplace"](around:{radius_m},{lat},{lon});
-
-      node["amenity"="arts_centre"](around:{radius_m},{lat},{lon});
-      way["amenity"="arts_centre"](around:{radius_m},{lat},{lon});
-      relation["amenity"="arts_centre"](around:{radius_m},{lat},{lon});
-
-      node["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"](around:{radius_m},{lat},{lon});
-      way["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"](around:{radius_m},{lat},{lon});
-      relation["tourism"="attraction"]["attraction"~"farm|botanical_garden|animal_park"](around:{radius_m},{lat},{lon});
-
-      node["leisure"="garden"]["garden"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-      way["leisure"="garden"]["garden"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-      relation["leisure"="garden"]["garden"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-      node["leisure"="garden"]["garden:type"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-      way["leisure"="garden"]["garden:type"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-      relation["leisure"="garden"]["garden:type"~"botanical|arboretum"](around:{radius_m},{lat},{lon});
-    );
+    {overpass_places_union(lat, lon, radius_m)};
     out center tags;
     """
-    return q
 
 def build_overpass_roads_query(lat, lon, radius_m):
-    hw = r"motorway|trunk|primary|secondary|motorway_link|trunk_link|primary_link|secondary_link"
     return f"""
     [out:json][timeout:30];
-    (
-      way["highway"~"{hw}"](around:{radius_m},{lat},{lon});
-      relation["highway"~"{hw}"](around:{radius_m},{lat},{lon});
-    );
+    {overpass_roads_union(lat, lon, radius_m)};
     out center tags;
     """
 
-@st.cache_data(show_spinner=False, ttl=1800)
-def fetch_overpass(q):
-    time.sleep(0.6)
-    r = http().post(OVERPASS_URL, data=q, timeout=60)
+def build_overpass_combined_query(lat, lon, radius_m, bbox=None):
+    # Places first, then a derived `section` marker element, then roads (see split_overpass_sections).
+    return f"""
+    [out:json][timeout:{45 if bbox is None else 90}];
+    {overpass_places_union(lat, lon, radius_m, bbox)}->.places;
+    {overpass_roads_union(lat, lon, radius_m, bbox)}->.roads;
+    .places out center tags;
+    make section name="roads";
+    out;
+    .roads out center tags;
+    """
+
+def split_overpass_sections(elements, first="places"):
+    parts, cur = {first: []}, first
+    for el in elements:
+        if el.get("type") == "section":
+            cur = el.get("tags", {}).get("name", cur)
+            parts.setdefault(cur, [])
+            continue
+        parts[cur].append(el)
+    return parts
+
+@st.cache_resource(show_spinner=False)
+def overpass_limiter():
+    return RateLimiter(float(os.getenv("APP_OVERPASS_MIN_INTERVAL_S", "0.6")))
+
+def post_overpass(q, timeout=60):
+    overpass_limiter().wait()
+    r = http().post(OVERPASS_URL, data=q, timeout=timeout)
     r.raise_for_status()
     return r.json().get("elements", [])
 
+@st.cache_data(show_spinner=False, ttl=1800)
+def fetch_overpass(q):
+    return post_overpass(q)
+
 @st.cache_data(show_spinner=False, ttl=1800)
 def fetch_places(lat, lon, radius_km):
-    els = fetch_overpass(build_overpass_places_query(lat, lon, int(radius_km*1000)))
+    return places_frame(fetch_overpass(build_overpass_places_query(lat, lon, int(radius_km*1000))), lat, lon)
+
+@st.cache_data(show_spinner=False, ttl=1800)
+def fetch_roads(lat, lon, radius_km):
+    return roads_frame(fetch_overpass(build_overpass_roads_query(lat, lon, int(radius_km*1000))))
+
+@st.cache_data(show_spinner=False, ttl=1800)
+def fetch_places_roads_combined(lat, lon, radius_km):
+    els = fetch_overpass(build_overpass_combined_query(lat, lon, int(radius_km*1000)))
+    parts = split_overpass_sections(els)
+    return places_frame(parts.get("places", []), lat, lon), roads_frame(parts.get("roads", []))
+
+def places_frame(els, lat, lon):
     rows = []
     for el in els:
         tags = el.get("tags", {})
@@ -657,18 +1493,18 @@ def fetch_places(lat, lon, radius_km):
         else:
             lat2, lon2 = el.get("lat"), el.get("lon")
         if lat2 is None or lon2 is None: continue
-        dist = haversine_km(lat, lon, lat2, lon2)
         name = tags.get("name") or tags.get("leisure") or tags.get("amenity") or tags.get("tourism") or tags.get("man_made") or "Unnamed"
         rows.append({
             "id": f'{el.get("type","")}/{el.get("id","")}',
-            "name": name, "lat": lat2, "lon": lon2,
-            "distance_km": dist, "tags": tags
+            "name": name, "lat": lat2, "lon": lon2, "tags": tags
         })
-    return pd.DataFrame(rows).sort_values("distance_km").reset_index(drop=True)
+    if not rows:
+        return pd.DataFrame(columns=["id","name","lat","lon","distance_km","tags"])
+    df = pd.DataFrame(rows)
+    df.insert(4, "distance_km", haversine_km_vec(lat, lon, df["lat"].values, df["lon"].values))
+    return df.sort_values("distance_km").reset_index(drop=True)
 
-@st.cache_data(show_spinner=False, ttl=1800)
-def fetch_roads(lat, lon, radius_km):
-    els = fetch_overpass(build_overpass_roads_query(lat, lon, int(radius_km*1000)))
+def roads_frame(els):
     rows = []
     for el in els:
         cen = el.get("center")
@@ -676,11 +1512,305 @@ def fetch_roads(lat, lon, radius_km):
         rows.append({"lat": cen["lat"], "lon": cen["lon"], "tags": el.get("tags", {})})
     return pd.DataFrame(rows)
 
+# =========================
+# Spatial index (nearest road)
+# =========================
+def unit_xyz(lat, lon):
+    phi = np.radians(np.asarray(lat, dtype=float))
+    lam = np.radians(np.asarray(lon, dtype=float))
+    cphi = np.cos(phi)
+    return np.stack([cphi*np.cos(lam), cphi*np.sin(lam), np.sin(phi)], axis=-1)
+
+class RoadIndex:
+    """Grid-bucket index over road centres on the unit sphere.
+
+    Points are bucketed into cubes whose side is the chord of `cell_m`. A road found in
+    the 3x3x3 neighbourhood closer than one cell is provably the nearest; anything else
+    falls back to a chunked brute-force scan.
+    """
+    R_KM = 6371.0
+
+    def __init__(self, lats, lons, cell_m=400.0):
+        self.lats = np.asarray(lats, dtype=float).ravel()
+        self.lons = np.asarray(lons, dtype=float).ravel()
+        self.xyz = unit_xyz(self.lats, self.lons).reshape(-1, 3)
+        self.cell = 2 * math.sin(cell_m / 1000.0 / (2 * self.R_KM))
+        self.buckets = {}
+        if len(self.xyz):
+            keys = np.floor(self.xyz / self.cell).astype(np.int64)
+            uniq, inv = np.unique(keys, axis=0, return_inverse=True)
+            order = np.argsort(inv.ravel(), kind="stable")
+            bounds = np.searchsorted(inv.ravel()[order], np.arange(len(uniq) + 1))
+            for i, k in enumerate(map(tuple, uniq.tolist())):
+                self.buckets[k] = order[bounds[i]:bounds[i+1]]
+
+    @classmethod
+    def from_frame(cls, roads, **kw):
+        if roads is None or roads.empty:
+            return cls([], [], **kw)
+        return cls(roads["lat"].values, roads["lon"].values, **kw)
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def nearest_m(self, lats, lons):
+        """Distance in metres from each query point to the nearest road (NaN if no roads)."""
+        lats = np.asarray(lats, dtype=float).ravel()
+        lons = np.asarray(lons, dtype=float).ravel()
+        q = unit_xyz(lats, lons).reshape(-1, 3)
+        if not len(self.xyz) or not len(q):
+            return np.full(len(q), np.nan)
+        best = np.full(len(q), np.inf)
+        arg = np.zeros(len(q), dtype=np.int64)
+        qkeys = np.floor(q / self.cell).astype(np.int64)
+        cells, inv = np.unique(qkeys, axis=0, return_inverse=True)
+        inv = inv.ravel()
+        offsets = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+        for ci, (kx, ky, kz) in enumerate(cells.tolist()):
+            cand = [self.buckets[k] for k in ((kx+dx, ky+dy, kz+dz) for dx, dy, dz in offsets) if k in self.buckets]
+            if not cand: continue
+            cand = np.concatenate(cand)
+            rows = np.flatnonzero(inv == ci)
+            d = np.linalg.norm(q[rows, None, :] - self.xyz[cand][None, :, :], axis=-1)
+            j = d.argmin(axis=1)
+            best[rows] = d[np.arange(len(rows)), j]
+            arg[rows] = cand[j]
+        far = np.flatnonzero(best > self.cell)
+        if len(far):
+            chunk = max(1, 2_000_000 // len(self.xyz))
+            for s in range(0, len(far), chunk):
+                rows = far[s:s+chunk]
+                d = np.linalg.norm(q[rows, None, :] - self.xyz[None, :, :], axis=-1)
+                arg[rows] = d.argmin(axis=1)
+        return haversine_km_vec(lats, lons, self.lats[arg], self.lons[arg]) * 1000.0
+
+OVERPASS_COMBINED = os.getenv("APP_OVERPASS_COMBINED", "1") != "0"
+
+@st.cache_resource(show_spinner=False, ttl=1800)
+def road_index(lat, lon, radius_km, combined=False):
+    roads = fetch_places_roads_combined(lat, lon, radius_km)[1] if combined else fetch_roads(lat, lon, radius_km)
+    return RoadIndex.from_frame(roads)
+
+def fetch_places_and_roads(lat, lon, radius_km):
+    """Returns (places, RoadIndex): one combined Overpass call, or the two queries side by side."""
+    if OVERPASS_COMBINED:
+        places, _ = fetch_places_roads_combined(lat, lon, radius_km)
+        return places, road_index(lat, lon, radius_km, combined=True)
+    f_places = submit_io(fetch_places, lat, lon, radius_km)
+    f_roads = submit_io(road_index, lat, lon, radius_km)
+    return f_places.result(), f_roads.result()
+
+CYCLEWAY_RADIUS_FACTOR = 0.7  # cycleways are queried at 70% of the search radius
+
+def clip_places(places, lat, lon, radius_km):
+    """Re-centre a places frame and keep elements whose centre falls inside the circle."""
+    if places is None or places.empty:
+        return places.copy() if places is not None else pd.DataFrame([])
+    dist = haversine_km_vec(lat, lon, places["lat"].values, places["lon"].values)
+    cycle = np.array([t.get("highway") == "cycleway" for t in places["tags"]], dtype=bool)
+    keep = dist <= np.where(cycle, radius_km * CYCLEWAY_RADIUS_FACTOR, radius_km)
+    out = places.loc[keep].copy()
+    out["distance_km"] = dist[keep]
+    return out.sort_values("distance_km").reset_index(drop=True)
+
+class AreaCache:
+    """Recent (places, RoadIndex) results by search circle.
+
+    A query circle contained in a cached one (including the shrunken cycleway circle) is
+    answered by clipping the cached superset locally. Roads are not clipped: extra roads
+    outside the circle only make nearest-road distances more accurate near the edge.
+    """
+    def __init__(self, ttl_s=1800, max_entries=32):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def lookup(self, lat, lon, radius_km):
+        now = time.time()
+        with self._lock:
+            self._entries = [e for e in self._entries if now - e["ts"] < self.ttl_s]
+            entries = list(self._entries)
+        best = None
+        for e in entries:
+            d = haversine_km(lat, lon, e["lat"], e["lon"])
+            if d + radius_km <= e["radius_km"] and d <= CYCLEWAY_RADIUS_FACTOR * (e["radius_km"] - radius_km):
+                if best is None or e["radius_km"] < best[0]["radius_km"]:
+                    best = (e, d)
+        if best is None:
+            return None
+        e, d = best
+        if d == 0 and e["radius_km"] == radius_km:
+            return e["places"].copy(), e["index"]
+        return clip_places(e["places"], lat, lon, radius_km), e["index"]
+
+    def store(self, lat, lon, radius_km, places, index):
+        with self._lock:
+            self._entries.append({"lat": lat, "lon": lon, "radius_km": radius_km, "places": places,
+                                  "index": index, "ts": time.time()})
+            self._entries = self._entries[-self.max_entries:]
+
+@st.cache_resource(show_spinner=False)
+def area_cache():
+    return AreaCache()
+
+def fetch_area(lat, lon, radius_km):
+    """Places and road index for a search circle: memory cache, then tile store, then Overpass."""
+    cache = area_cache()
+    hit = cache.lookup(lat, lon, radius_km)
+    if hit is not None:
+        return hit
+    if OSM_TILE_CACHE:
+        places, index = fetch_tiles_area(lat, lon, radius_km)
+    else:
+        places, index = fetch_places_and_roads(lat, lon, radius_km)
+    cache.store(lat, lon, radius_km, places, index)
+    return places.copy(), index
+
+# =========================
+# OSM tile cache (persistent, SQLite)
+# =========================
+OSM_TILE_CACHE = os.getenv("APP_OSM_TILE_CACHE", "1") != "0"
+OSM_TILE_ZOOM = int(os.getenv("APP_OSM_TILE_ZOOM", "12"))
+OSM_TILE_TTL_S = float(os.getenv("APP_OSM_TILE_TTL_S", str(7*24*3600)))
+
+def lonlat_to_tile(lat, lon, z=OSM_TILE_ZOOM):
+    n = 2 ** z
+    lat = max(-85.0511, min(85.0511, lat))
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n-1), min(max(y, 0), n-1)
+
+def tile_bbox(x, y, z=OSM_TILE_ZOOM):
+    # (south, west, north, east) of a slippy-map tile
+    n = 2 ** z
+    def lat_of(yy): return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * yy / n))))
+    return lat_of(y + 1), x / n * 360.0 - 180.0, lat_of(y), (x + 1) / n * 360.0 - 180.0
+
+def tiles_for_circle(lat, lon, radius_km, z=OSM_TILE_ZOOM):
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * max(0.01, math.cos(math.radians(lat))))
+    x0, y0 = lonlat_to_tile(lat + dlat, lon - dlon, z)
+    x1, y1 = lonlat_to_tile(lat - dlat, lon + dlon, z)
+    return [(z, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+def _tile_range(tiles):
+    return (tiles[0][0], min(t[1] for t in tiles), max(t[1] for t in tiles), min(t[2] for t in tiles), max(t[2] for t in tiles))
+
+def stale_tiles(tiles):
+    if not tiles: return []
+    with db_read() as cur:
+        cur.execute("SELECT z, x, y FROM osm_tiles WHERE z=? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ? AND fetched_at>=?",
+                    (*_tile_range(tiles), time.time() - OSM_TILE_TTL_S))
+        fresh = {(r["z"], r["x"], r["y"]) for r in cur.fetchall()}
+    return [t for t in tiles if t not in fresh]
+
+@st.cache_resource(show_spinner=False)
+def tile_fetch_locks():
+    return KeyedLocks()
+
+def fetch_tiles(tiles):
+    """Fetch the given tiles in one combined bbox query and replace their stored elements."""
+    if not tiles: return
+    boxes = [tile_bbox(x, y, z) for z, x, y in tiles]
+    bbox = (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+    els = post_overpass(build_overpass_combined_query(None, None, None, bbox=bbox), timeout=120)
+    wanted, z = set(tiles), tiles[0][0]
+    parts = split_overpass_sections(els)
+    rows = []
+    for layer, part in (("place", "places"), ("road", "roads")):
+        for el in parts.get(part, []):
+            # each element is stored once, under the tile holding its centre
+            cen = el.get("center") or ({"lat": el["lat"], "lon": el["lon"]} if "lat" in el and "lon" in el else None)
+            if not cen: continue
+            t = (z, *lonlat_to_tile(cen["lat"], cen["lon"], z))
+            if t not in wanted: continue
+            rows.append((*t, layer, el.get("type", ""), el.get("id", 0), cen["lat"], cen["lon"], json.dumps(el.get("tags", {}))))
+    now = time.time()
+    with db_tx() as cur:
+        for z, x, y in tiles:
+            cur.execute("DELETE FROM osm_tile_elements WHERE z=? AND x=? AND y=?", (z, x, y))
+        cur.executemany("INSERT OR REPLACE INTO osm_tile_elements (z,x,y,layer,osm_type,osm_id,lat,lon,tags) VALUES (?,?,?,?,?,?,?,?,?)", rows)
+        cur.executemany("INSERT OR REPLACE INTO osm_tiles (z,x,y,fetched_at) VALUES (?,?,?,?)", [(z, x, y, now) for z, x, y in tiles])
+
+def load_tile_elements(tiles):
+    out = {"place": [], "road": []}
+    if not tiles: return out
+    with db_read() as cur:
+        cur.execute("SELECT layer, osm_type, osm_id, lat, lon, tags FROM osm_tile_elements WHERE z=? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?",
+                    _tile_range(tiles))
+        rows = cur.fetchall()
+    for r in rows:
+        out[r["layer"]].append({"type": r["osm_type"], "id": r["osm_id"],
+                                "center": {"lat": r["lat"], "lon": r["lon"]}, "tags": json.loads(r["tags"])})
+    return out
+
+def fetch_tiles_area(lat, lon, radius_km):
+    """Assemble a search circle from stored tiles, fetching only missing or stale ones."""
+    tiles = tiles_for_circle(lat, lon, radius_km)
+    stale = stale_tiles(tiles)
+    if stale:
+        # lock only the tiles being fetched: searches elsewhere proceed, overlapping ones wait and reuse the result
+        with tile_fetch_locks().hold(*stale):
+            fetch_tiles(stale_tiles(stale))
+    els = load_tile_elements(tiles)
+    places = clip_places(places_frame(els["place"], lat, lon), lat, lon, radius_km)
+    return places, RoadIndex.from_frame(roads_frame(els["road"]))
+
 # =========================
 # Classification & scoring
 # =========================
+def feature_activities(kind, is_free, is_paid):
+    activities = set()
+    if kind in ["Park","Recreation ground","Open sports field","Playground / fitness area"]:
+        activities.update(["Walking","Hiking","Parks","Playgrounds","Sports fields"])
+    if kind in ["Cycleway / greenway","Running track","Boardwalk / beach / pier"]:
+        activities.update(["Walking","Running","Cycling","Beaches","Tracks","Greenways"])
+    if kind == "Swimming (pool)":
+        activities.add("Swimming")
+    if kind in ["Community center","Arts centre","Marketplace"]:
+        activities.add("Community events"); activities.add("Community centers")
+    if kind == "Museum":
+        activities.add("Museums")
+    if kind == "Botanical garden":
+        activities.add("Botanical gardens")
+    if kind in ["Zoo","Animal park"]:
+        activities.add("Community events")
+    if kind in ["Farm (attraction)","Farm shop"]:
+        activities.add("Farms")
+    if kind == "Ice rink":
+        activities.add("Ice skating")
+    if is_free is True: activities.add("Free")
+    if is_paid is True: activities.add("Paid")
+    return activities
+
+CLASSIFY_TAG_KEYS = ("leisure","amenity","tourism","man_made","highway","attraction","garden","garden:type",
+                     "indoor","covered","surface","tracktype","fee","access","wheelchair","shop")
+
+@st.cache_resource(show_spinner=False)
+def classify_cache():
+    return LRUCache(int(os.getenv("APP_CLASSIFY_CACHE_SIZE", "50000")))
+
+def classify_cache_stats():
+    return classify_cache().stats()
+
+def classification_key(tags):
+    return tuple(tags.get(k) for k in CLASSIFY_TAG_KEYS) + (tags.get("name") is None,)
+
 def classify_feature(row):
     tags = row.get("tags", {})
+    key = classification_key(tags)
+    cache = classify_cache()
+    hit = cache.get(key)
+    if hit is None:
+        cls = _classify_tags(tags)
+        hit = tuple(cls[c] for c in _CLASS_COLUMNS[:-1]) + (frozenset(cls["activities"]),)
+        cache.put(key, hit)
+    out = dict(zip(_CLASS_COLUMNS, hit))
+    out["activities"] = set(out["activities"])
+    return out
+
+def _classify_tags(tags):
     kind=None; indoor=False; shaded=False; waterfront=False; pollen_risk="medium"
     paved = tags.get("surface") in {"paved","asphalt","concrete","paving_stones","wood"} or tags.get("tracktype")=="grade1"
     wheelchair = (tags.get("wheelchair")=="yes")
@@ -733,27 +1863,7 @@ def classify_feature(row):
     else:
         kind = tags.get("leisure") or tags.get("amenity") or tags.get("tourism") or tags.get("man_made") or "Public place"
 
-    activities = set()
-    if kind in ["Park","Recreation ground","Open sports field","Playground / fitness area"]:
-        activities.update(["Walking","Hiking","Parks","Playgrounds","Sports fields"])
-    if kind in ["Cycleway / greenway","Running track","Boardwalk / beach / pier"]:
-        activities.update(["Walking","Running","Cycling","Beaches","Tracks","Greenways"])
-    if kind == "Swimming (pool)":
-        activities.add("Swimming")
-    if kind in ["Community center","Arts centre","Marketplace"]:
-        activities.add("Community events"); activities.add("Community centers")
-    if kind == "Museum":
-        activities.add("Museums")
-    if kind == "Botanical garden":
-        activities.add("Botanical gardens")
-    if kind in ["Zoo","Animal park"]:
-        activities.add("Community events")
-    if kind in ["Farm (attraction)","Farm shop"]:
-        activities.add("Farms")
-    if kind == "Ice rink":
-        activities.add("Ice skating")
-    if is_free is True: activities.add("Free")
-    if is_paid is True: activities.add("Paid")
+    activities = feature_activities(kind, is_free, is_paid)
 
     return {
         "kind": kind, "indoor": indoor, "shaded_possible": shaded, "waterfront": waterfront,
@@ -761,126 +1871,406 @@ def classify_feature(row):
         "is_paid": is_paid, "is_free": is_free, "activities": activities,
     }
 
+# Scoring rules: (sensitivity, feature predicate, weight). A sensitivity of None applies always.
+# Predicates: ("flag", column) | ("kind", [kinds]) | ("pollen", level)
+#             ("road", lo, hi) -> known road distance in [lo, hi) | ("road_gt", x)
+# Set APP_SCORE_RULES to a JSON list of {"sensitivity", "when", "weight"} to override the table, either inline
+# or as the path of a file holding it.
+SCORE_RULES = [
+    ("UV sensitivity", ("flag", "indoor"), 28),
+    ("UV sensitivity", ("flag", "shaded_possible"), 12),
+    ("UV sensitivity", ("flag", "waterfront"), 6),
+    ("UV sensitivity", ("kind", ["Open sports field","Running track"]), -5),
+    ("Pollen sensitivity", ("flag", "indoor"), 26),
+    ("Pollen sensitivity", ("flag", "waterfront"), 12),
+    ("Pollen sensitivity", ("pollen", "higher"), -18),
+    ("Pollen sensitivity", ("pollen", "low"), 8),
+    ("Breathing sensitivity", ("flag", "indoor"), 12),
+    ("Breathing sensitivity", ("flag", "waterfront"), 8),
+    ("Breathing sensitivity", ("flag", "paved"), 6),
+    ("Breathing sensitivity", ("kind", ["Open sports field"]), -4),
+    ("Smog sensitivity", ("road", None, 80), -24),
+    ("Smog sensitivity", ("road", 80, 180), -16),
+    ("Smog sensitivity", ("road", 180, 350), -8),
+    ("Smog sensitivity", ("road", 350, None), 4),
+    ("Low impact", ("flag", "paved"), 10),
+    ("Low impact", ("flag", "indoor"), 6),
+    ("Low impact", ("kind", ["Running track","Swimming (pool)","Cycleway / greenway"]), 10),
+    ("Low impact", ("kind", ["Open sports field","Playground / fitness area"]), -4),
+    ("Noise sensitivity", ("road", None, 80), -22),
+    ("Noise sensitivity", ("road", 80, 180), -12),
+    ("Noise sensitivity", ("road", 180, 350), -6),
+    ("Noise sensitivity", ("road", 350, None), 6),
+    ("Noise sensitivity", ("flag", "quiet_hint"), 4),
+    ("Privacy", ("road_gt", 350), 10),
+    ("Privacy", ("flag", "quiet_hint"), 6),
+    ("Privacy", ("kind", ["Boardwalk / beach / pier","Playground / fitness area"]), -4),
+    ("Accessibility", ("flag", "wheelchair"), 20),
+    ("Accessibility", ("flag", "paved"), 8),
+    ("Accessibility", ("kind", ["Community center","Sports centre","Swimming (pool)"]), 6),
+    (None, ("kind", ["Park","Cycleway / greenway","Running track","Boardwalk / beach / pier","Recreation ground","Outdoor fitness station"]), 6),
+]
+
+def _pred_key(pred):
+    return json.dumps(pred)
+
+@st.cache_resource(show_spinner=False)
+def score_rule_table(source=None):
+    source = (source or os.getenv("APP_SCORE_RULES") or "").strip()
+    rules = SCORE_RULES
+    if source:
+        if source.startswith("["): raw = json.loads(source)
+        else:
+            with open(source, encoding="utf-8") as fh: raw = json.load(fh)
+        rules = [(r.get("sensitivity"), r["when"], r["weight"]) for r in raw]
+    preds = {}
+    for _, pred, _ in rules:
+        preds.setdefault(_pred_key(pred), pred)
+    return rules, list(preds.values())
+
+@st.cache_resource(show_spinner=False)
+def compiled_score_weights(active_key: tuple):
+    rules, preds = score_rule_table()
+    col = {_pred_key(p): i for i, p in enumerate(preds)}
+    w = np.zeros(len(preds))
+    for sens, pred, weight in rules:
+        if sens is None or sens in active_key:
+            w[col[_pred_key(pred)]] += weight
+    return w
+
+def _eval_predicate(feats, road, pred):
+    op = pred[0]
+    if op == "flag": return feats[pred[1]].values.astype(bool)
+    if op == "kind": return feats["kind"].isin(pred[1]).values
+    if op == "pollen": return (feats["pollen_risk"] == pred[1]).values
+    known = ~np.isnan(road)
+    if op == "road":
+        lo, hi = pred[1], pred[2]
+        if lo is not None: known = known & (road >= lo)
+        if hi is not None: known = known & (road < hi)
+        return known
+    if op == "road_gt": return known & (road > pred[1])
+    raise ValueError(f"Unknown score predicate: {pred!r}")
+
+def feature_matrix(feats, preds):
+    road = pd.to_numeric(feats["road_distance_m"], errors="coerce").values.astype(float) if "road_distance_m" in feats else np.full(len(feats), np.nan)
+    if not preds: return np.zeros((len(feats), 0))
+    return np.column_stack([_eval_predicate(feats, road, p) for p in preds]).astype(float)
+
 def score_feature(feat, active, distance_km, road_distance_m):
-    score = max(0, 100 - distance_km * 8)
-    if "UV sensitivity" in active:
-        if feat["indoor"]: score += 28
-        if feat["shaded_possible"]: score += 12
-        if feat["waterfront"]: score += 6
-        if feat["kind"] in ["Open sports field","Running track"]: score -= 5
-    if "Pollen sensitivity" in active:
-        if feat["indoor"]: score += 26
-        if feat["waterfront"]: score += 12
-        if feat["pollen_risk"] == "higher": score -= 18
-        elif feat["pollen_risk"] == "low": score += 8
-    if "Breathing sensitivity" in active:
-        if feat["indoor"]: score += 12
-        if feat["waterfront"]: score += 8
-        if feat["paved"]: score += 6
-        if feat["kind"] in ["Open sports field"]: score -= 4
-    if "Smog sensitivity" in active:
-        if road_distance_m is not None:
-            if road_distance_m < 80: score -= 24
-            elif road_distance_m < 180: score -= 16
-            elif road_distance_m < 350: score -= 8
-            else: score += 4
-    if "Low impact" in active:
-        if feat["paved"]: score += 10
-        if feat["indoor"]: score += 6
-        if feat["kind"] in ["Running track","Swimming (pool)","Cycleway / greenway"]: score += 10
-        if feat["kind"] in ["Open sports field","Playground / fitness area"]: score -= 4
-    if "Noise sensitivity" in active:
-        if road_distance_m is not None:
-            if road_distance_m < 80: score -= 22
-            elif road_distance_m < 180: score -= 12
-            elif road_distance_m < 350: score -= 6
-            else: score += 6
-        if feat["quiet_hint"]: score += 4
-    if "Privacy" in active:
-        if road_distance_m is not None and road_distance_m > 350: score += 10
-        if feat["quiet_hint"]: score += 6
-        if feat["kind"] in ["Boardwalk / beach / pier","Playground / fitness area"]: score -= 4
-    if "Accessibility" in active:
-        if feat["wheelchair"]: score += 20
-        if feat["paved"]: score += 8
-        if feat["kind"] in ["Community center","Sports centre","Swimming (pool)"]: score += 6
-    if feat["kind"] in ["Park","Cycleway / greenway","Running track","Boardwalk / beach / pier","Recreation ground","Outdoor fitness station"]:
-        score += 6
-    return round(score, 1)
+    row = {**feat, "distance_km": distance_km, "road_distance_m": road_distance_m}
+    return float(score_frame(pd.DataFrame([row]), active).iloc[0])
+
+# =========================
+# Batch classification & scoring (columnar)
+# =========================
+_BRANCH_KINDS = [
+    "Community center", "Swimming (pool)", "Park", "Playground / fitness area", "Outdoor fitness station",
+    "Running track", "Boardwalk / beach / pier", "Open sports field", "Recreation ground", "Ice rink",
+    "Sports centre", "Cycleway / greenway", "Museum", "Marketplace", "Arts centre",
+    "Farm (attraction)", "Botanical garden", "Animal park", "Botanical garden", "Farm shop",
+]
+_CLASS_COLUMNS = ["kind","indoor","shaded_possible","waterfront","pollen_risk","paved","wheelchair","quiet_hint","is_paid","is_free","activities"]
+
+_BOOL_CLASS_COLUMNS = ["indoor","shaded_possible","waterfront","paved","wheelchair","quiet_hint"]
+
+def classify_frame(places):
+    """Columnar equivalent of classify_feature over a DataFrame with a `tags` column.
+
+    Rows are deduplicated on classification_key; only keys missing from the shared LRU
+    go through the columnar engine, the rest are broadcast from cached results.
+    """
+    if places is None or places.empty:
+        return pd.DataFrame(columns=_CLASS_COLUMNS, index=getattr(places, "index", None))
+    tags = places["tags"].tolist()
+    uniq, first = {}, []
+    codes = np.empty(len(tags), dtype=np.int64)
+    for i, t in enumerate(tags):
+        k = classification_key(t)
+        if k not in uniq:
+            uniq[k] = len(uniq); first.append(i)
+        codes[i] = uniq[k]
+    ukeys = list(uniq)
+    cache = classify_cache()
+    vals = [cache.get(k) for k in ukeys]
+    miss = [j for j, v in enumerate(vals) if v is None]
+    if miss:
+        fresh = _classify_columns(pd.DataFrame({"tags": [tags[first[j]] for j in miss]}))
+        for r, j in enumerate(miss):
+            rec = fresh.iloc[r]
+            vals[j] = tuple(bool(rec[c]) if c in _BOOL_CLASS_COLUMNS else rec[c] for c in _CLASS_COLUMNS[:-1]) + (frozenset(rec["activities"]),)
+            cache.put(ukeys[j], vals[j])
+    out = {}
+    for ci, c in enumerate(_CLASS_COLUMNS):
+        colv = np.empty(len(vals), dtype=object)
+        for j, v in enumerate(vals): colv[j] = v[ci]
+        colv = colv[codes]
+        if c in _BOOL_CLASS_COLUMNS: colv = colv.astype(bool)
+        elif c == "activities": colv = [set(a) for a in colv]
+        out[c] = colv
+    return pd.DataFrame(out, index=places.index)
+
+def _classify_columns(places):
+    tags = places["tags"].tolist()
+    def col(key): return pd.Series([t.get(key) for t in tags], dtype=object)
+    leisure, amenity, tourism, man_made = col("leisure"), col("amenity"), col("tourism"), col("man_made")
+    highway, attraction, garden, garden_type = col("highway"), col("attraction"), col("garden"), col("garden:type")
+    access, fee, name = col("access"), col("fee"), col("name")
+    indoor_yes = (col("indoor") == "yes").values
+    covered_yes = (col("covered") == "yes").values
+
+    fee_l = fee.fillna("").str.lower()
+    access_l = access.fillna("").str.lower()
+    paid = np.where(fee_l == "yes", True, np.where(fee_l == "no", False, None))
+    free = np.where((fee_l == "no") | access_l.isin(["public","yes"]), True, np.where(fee_l == "yes", False, None))
+
+    attr = (tourism == "attraction")
+    bot = ["botanical","arboretum"]
+    conds = [
+        amenity == "community_centre", leisure == "swimming_pool", leisure == "park", leisure == "playground",
+        leisure == "fitness_station", leisure == "track", (man_made == "pier") | (tourism == "beach"),
+        leisure == "pitch", leisure == "recreation_ground", leisure == "ice_rink", leisure == "sports_centre",
+        highway == "cycleway", tourism == "museum", amenity == "marketplace", amenity == "arts_centre",
+        attr & (attraction == "farm"), attr & (attraction == "botanical_garden"), attr & (attraction == "animal_park"),
+        (leisure == "garden") & (garden.isin(bot) | garden_type.isin(bot)), col("shop") == "farm",
+    ]
+    branch = np.select([c.values for c in conds], np.arange(len(conds)), default=len(conds))
+    fallback = [t.get("leisure") or t.get("amenity") or t.get("tourism") or t.get("man_made") or "Public place" for t in tags]
+    kind = np.where(branch < len(_BRANCH_KINDS), np.array(_BRANCH_KINDS + [""], dtype=object)[branch], np.array(fallback, dtype=object))
+
+    indoor = (np.isin(branch, [0, 12, 14])
+              | (np.isin(branch, [1, 10]) & (indoor_yes | covered_yes))
+              | ((branch == 9) & indoor_yes))
+    pollen = np.full(len(tags), "medium", dtype=object)
+    pollen[np.isin(branch, [0, 6, 12, 14]) | (np.isin(branch, [1, 9, 10]) & indoor)] = "low"
+    pollen[np.isin(branch, [2, 3, 4, 7])] = "higher"
+    surface = col("surface")
+    paved = (surface.isin(["paved","asphalt","concrete","paving_stones","wood"]) | (col("tracktype") == "grade1")).values
+    paved = paved | np.isin(branch, [5, 6, 11])
+
+    acts = {}
+    activities = []
+    for k, f, p in zip(kind, free, paid):
+        key = (k, f, p)
+        if key not in acts: acts[key] = feature_activities(k, f, p)
+        activities.append(set(acts[key]))
+
+    return pd.DataFrame({
+        "kind": kind, "indoor": indoor, "shaded_possible": np.isin(branch, [2, 3, 4]),
+        "waterfront": branch == 6, "pollen_risk": pollen, "paved": paved,
+        "wheelchair": (col("wheelchair") == "yes").values,
+        "quiet_hint": (access.isna() | (access == "yes")).values & name.isna().values,
+        "is_paid": paid, "is_free": free, "activities": activities,
+    }, index=places.index)
+
+def score_frame(feats, active):
+    """Vectorized scoring: distance base plus the compiled rule weights dotted with the feature matrix."""
+    if feats is None or feats.empty:
+        return pd.Series([], dtype=float, index=getattr(feats, "index", None))
+    _, preds = score_rule_table()
+    w = compiled_score_weights(tuple(sorted(set(active))))
+    score = np.maximum(0, 100 - feats["distance_km"].values.astype(float) * 8) + feature_matrix(feats, preds) @ w
+    return pd.Series([round(float(x), 1) for x in score], index=feats.index, dtype=float)
 
 # =========================
 # Weather windows
 # =========================
+# Forecast store: the full OneCall response (48 h hourly + 8-day daily) per grid cell, fetched for the
+# cell centre so every search inside the cell shares it until FORECAST_TTL_S (OWM refreshes hourly).
+FORECAST_CELL_DEG = float(os.getenv("APP_FORECAST_CELL_DEG", "0.1"))
+FORECAST_TTL_S = int(os.getenv("APP_FORECAST_TTL_S", "3600"))
+FORECAST_STALE_S = 24 * 3600  # still better than the heuristic if OWM is down
+FORECAST_DAYS = 7
+
+def forecast_cell(lat, lon):
+    i, j = round(lat / FORECAST_CELL_DEG), round(lon / FORECAST_CELL_DEG)
+    return f"{FORECAST_CELL_DEG:g}:{i}:{j}", round(i * FORECAST_CELL_DEG, 6), round(j * FORECAST_CELL_DEG, 6)
+
+def forecast_store_get(cell):
+    with db_read() as cur:
+        cur.execute("SELECT issued_at, fetched_at, payload FROM forecast_cells WHERE cell=?", (cell,))
+        row = cur.fetchone()
+    if not row: return None
+    return {"issued_at": row["issued_at"], "fetched_at": row["fetched_at"], "data": json.loads(row["payload"])}
+
+def forecast_store_put(cell, lat, lon, data):
+    issued = (data.get("current") or {}).get("dt") or next((h.get("dt") for h in data.get("hourly", [])), None)
+    with db_tx() as cur:
+        cur.execute("""
+          INSERT INTO forecast_cells (cell,lat,lon,issued_at,fetched_at,payload) VALUES (?,?,?,?,?,?)
+          ON CONFLICT(cell) DO UPDATE SET lat=excluded.lat, lon=excluded.lon, issued_at=excluded.issued_at,
+            fetched_at=excluded.fetched_at, payload=excluded.payload
+        """, (cell, lat, lon, issued, time.time(), json.dumps(data, separators=(",", ":"))))
+
+@st.cache_resource
+def forecast_fetch_locks():
+    return KeyedLocks()
+
+def get_forecast(lat, lon, owm_key):
+    """Stored forecast for the cell around (lat, lon), refreshed from OneCall once it's older than FORECAST_TTL_S.
+    Returns the store entry ({"issued_at", "fetched_at", "data"}) or None."""
+    cell, clat, clon = forecast_cell(lat, lon)
+    entry = forecast_store_get(cell)
+    if entry and time.time() - entry["fetched_at"] < FORECAST_TTL_S:
+        return entry
+    with forecast_fetch_locks().hold(cell):
+        entry = forecast_store_get(cell)  # another session may have refreshed it meanwhile
+        if entry and time.time() - entry["fetched_at"] < FORECAST_TTL_S:
+            return entry
+        try:
+            r = http().get(OWM_ONECALL_URL, params={"lat":clat,"lon":clon,"units":"metric","appid":owm_key,"exclude":"minutely,alerts"}, timeout=30)
+            r.raise_for_status()
+            forecast_store_put(cell, clat, clon, r.json())
+            return forecast_store_get(cell)
+        except Exception:
+            return entry if entry and time.time() - entry["fetched_at"] < FORECAST_STALE_S else None
+
 @st.cache_data(show_spinner=False, ttl=1800)
-def fetch_weather_context(lat, lon, tzname, keys):
+def fetch_weather_context(lat, lon, tzname, keys, day_offset=0):
     tz = pytz.timezone(tzname)
-    today = datetime.now(tz).date()
-    base_hours = [tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=h)) for h in range(6,22)]
+    day = datetime.now(tz).date() + timedelta(days=day_offset)
+    base_hours = [tz.localize(datetime.combine(day, datetime.min.time()) + timedelta(hours=h)) for h in range(6,22)]
     def heuristic_uv(h): return 7 if 10<=h<=16 else (4 if h in (9,17) else 2)
     hourly = [{"time": dt, "uvi": heuristic_uv(dt.hour), "rain": False} for dt in base_hours]
     notes, daily_uvi = [], None
-    if keys.get("owm"):
-        try:
-            r = http().get(OWM_ONECALL_URL, params={"lat":lat,"lon":lon,"units":"metric","appid":keys["owm"],"exclude":"minutely,alerts"}, timeout=30)
-            r.raise_for_status(); w = r.json()
-            rain_hours = set()
-            for h in w.get("hourly", [])[:24]:
-                dt_local = datetime.fromtimestamp(h["dt"], tz=timezone.utc).astimezone(tz)
-                if dt_local.date()==today and (("rain" in h and h["rain"]) or (h.get("pop",0)>=0.5 and h.get("clouds",0)>=70)):
-                    rain_hours.add(dt_local.hour)
-            for rec in hourly:
-                if rec["time"].hour in rain_hours: rec["rain"]=True
-            if w.get("daily"):
-                daily_uvi = w["daily"][0].get("uvi"); notes.append(f"Daily max UV index (forecast): {daily_uvi}")
-        except Exception:
-            notes.append("OpenWeatherMap unavailable or key missing — using heuristic UV/rain.")
-    return {"tzname": tzname, "date": str(today), "hourly": hourly, "daily_uvi": daily_uvi, "notes": notes}
+    fc = get_forecast(lat, lon, keys["owm"]) if keys.get("owm") else None
+    if fc:
+        w = fc["data"]
+        rain_hours, covered = set(), set()
+        for h in w.get("hourly", []):
+            dt_local = datetime.fromtimestamp(h["dt"], tz=timezone.utc).astimezone(tz)
+            if dt_local.date() != day: continue
+            covered.add(dt_local.hour)
+            if ("rain" in h and h["rain"]) or (h.get("pop",0)>=0.5 and h.get("clouds",0)>=70):
+                rain_hours.add(dt_local.hour)
+        for rec in hourly:
+            if rec["time"].hour in rain_hours: rec["rain"]=True
+        if not covered:
+            notes.append("Hourly forecast covers the next 48 h — rain timing for this day is not available yet.")
+        for d in w.get("daily", []):
+            if datetime.fromtimestamp(d["dt"], tz=timezone.utc).astimezone(tz).date() == day:
+                daily_uvi = d.get("uvi"); notes.append(f"Daily max UV index (forecast): {daily_uvi}")
+                break
+        if time.time() - fc["fetched_at"] >= FORECAST_TTL_S:
+            notes.append("Using an earlier forecast — OpenWeatherMap is unavailable right now.")
+    else:
+        notes.append("OpenWeatherMap unavailable or key missing — using heuristic UV/rain.")
+    return {"tzname": tzname, "date": str(day), "hourly": hourly, "daily_uvi": daily_uvi, "notes": notes}
+
+def contiguous_runs(mask):
+    """Runs of True along the last axis of a (days, hours) mask -> (day, start, end) index arrays, end inclusive."""
+    m = np.atleast_2d(np.asarray(mask, dtype=np.int8))
+    d = np.diff(np.pad(m, ((0, 0), (1, 1))), axis=1)
+    day, start = np.nonzero(d == 1)  # row-major, so starts and ends pair up
+    _, stop = np.nonzero(d == -1)
+    return day, start, stop - 1
 
 def contiguous_windows(times, good_mask):
-    out, start = [], None
-    for i, good in enumerate(good_mask):
-        if good and start is None: start = i
-        if (not good or i==len(good_mask)-1) and start is not None:
-            end = i if good else i-1; out.append((start,end)); start=None
-    return out
+    _, start, end = contiguous_runs(good_mask)
+    return list(zip(start.tolist(), end.tolist()))
+
+POLLEN_SENSITIVITIES = ("Pollen sensitivity", "Breathing sensitivity")
+
+POLLEN_RISK_ADJ = {"low": -1, "medium": 0, "higher": 1}
+
+def window_risk(uvi, rain, hour, active, indoor=None, shaded=None, pollen_adj=None):
+    """Hourly exposure risk for (days, hours) arrays: UV bands plus the morning/evening pollen peaks (eased by rain).
+    Optional per-place (N,) arrays turn a single day into an (N, hours) risk: indoor places carry no risk,
+    shade lowers the UV band by one and pollen_adj shifts the pollen term."""
+    hour = np.asarray(hour)
+    col = lambda a: np.asarray(a)[:, None]
+    risk = np.zeros(hour.shape, dtype=np.int16)
+    if "UV sensitivity" in active:
+        uv = np.nan_to_num(np.asarray(uvi, dtype=float), nan=2.0)
+        band = np.where(uv >= 7, 3, np.where(uv >= 4, 2, 1)).astype(np.int16)
+        risk = risk + (np.maximum(band - col(shaded).astype(np.int16), 1) if shaded is not None else band)
+    if any(a in active for a in POLLEN_SENSITIVITIES):
+        peak = ((hour >= 5) & (hour <= 10)) | ((hour >= 16) & (hour <= 20))
+        pollen = np.where(peak, 2, 1).astype(np.int16) - np.asarray(rain, dtype=np.int16)
+        risk = risk + (pollen + col(pollen_adj).astype(np.int16) if pollen_adj is not None else pollen)
+    if indoor is not None:
+        risk = np.where(col(indoor).astype(bool), 0, risk)
+    return np.maximum(risk, 0)
+
+def window_runs(uvi, rain, hour, active, max_risk=2, **place):
+    """Low-risk windows over (days, hours) arrays -> (day, start, end, rained) with inclusive hour indices;
+    `rained` flags windows containing a rain hour. With per-place arrays (see window_risk) `day` indexes places."""
+    risk = window_risk(np.atleast_2d(uvi), np.atleast_2d(rain), np.atleast_2d(hour), active, **place)
+    day, start, end = contiguous_runs(risk <= max_risk)
+    rain = np.broadcast_to(np.atleast_2d(np.asarray(rain, dtype=bool)), risk.shape)
+    rain_cs = np.pad(np.cumsum(rain, axis=1), ((0, 0), (1, 0)))
+    return day, start, end, rain_cs[day, end + 1] > rain_cs[day, start]
+
+def weather_arrays(weather_ctx):
+    hourly = weather_ctx["hourly"]
+    return (np.array([rec.get("uvi", 2) for rec in hourly], dtype=float),
+            np.array([bool(rec.get("rain")) for rec in hourly]),
+            np.array([rec["time"].hour for rec in hourly]))
 
 def pretty_time(dt):
     try: return dt.strftime("%-I:%M %p")
     except ValueError: return dt.strftime("%I:%M %p").lstrip("0")
 
+def _window_why(active, rained):
+    why = []
+    if "UV sensitivity" in active: why.append("lower UV")
+    if any(a in active for a in POLLEN_SENSITIVITIES):
+        why.append("lower pollen (est.)" + (" after rain" if rained else ""))
+    return ", ".join(why) if why else "comfortable"
+
 def build_time_windows(weather_ctx, active):
+    return build_time_windows_multi([weather_ctx], active)[0]
+
+def build_time_windows_multi(weather_ctxs, active):
+    """build_time_windows for many days/locations at once: contexts with the same hour count are stacked
+    into (days, hours) arrays and scored in one pass."""
+    out = [None] * len(weather_ctxs)
+    by_len = {}
+    for i, ctx in enumerate(weather_ctxs):
+        by_len.setdefault(len(ctx["hourly"]), []).append(i)
+    for idxs in by_len.values():
+        uvi, rain, hour = (np.stack(a) for a in zip(*(weather_arrays(weather_ctxs[i]) for i in idxs)))
+        day, start, end, rained = window_runs(uvi, rain, hour, active)
+        per_day = [[] for _ in idxs]
+        for d, s, e, r in zip(day.tolist(), start.tolist(), end.tolist(), rained.tolist()):
+            hourly = weather_ctxs[idxs[d]]["hourly"]
+            per_day[d].append((hourly[s]["time"], hourly[e]["time"] + timedelta(hours=1), _window_why(active, r)))
+        for i, windows in zip(idxs, per_day):
+            out[i] = windows or _fallback_windows(weather_ctxs[i])
+    return out
+
+def place_windows(features, weather_ctx, active, per_place=2):
+    """Best windows for every row of `features` against one day's hourly context, in one pass:
+    the longest low-risk runs per place (up to `per_place`, in time order). Places with none get []."""
+    n = len(features)
+    out = [[] for _ in range(n)]
+    if n == 0 or not weather_ctx["hourly"]:
+        return out
+    uvi, rain, hour = weather_arrays(weather_ctx)
+    indoor = features["indoor"].astype(bool).values
+    day, start, end, rained = window_runs(
+        uvi, rain, hour, active, indoor=indoor, shaded=features["shaded_possible"].astype(bool).values,
+        pollen_adj=features["pollen_risk"].map(POLLEN_RISK_ADJ).fillna(0).astype(int).values)
+    if len(day) == 0:
+        return out
+    order = np.lexsort((start, start - end, day))  # per place: longest first, then earliest
+    d = day[order]
+    first = np.r_[0, np.flatnonzero(np.diff(d)) + 1]
+    rank = np.arange(len(d)) - np.repeat(first, np.diff(np.r_[first, len(d)]))
+    keep = order[rank < per_place]
+    keep = keep[np.lexsort((start[keep], day[keep]))]
     hourly = weather_ctx["hourly"]
-    risks=[]
-    for rec in hourly:
-        h = rec["time"].hour
-        risk = 0
-        if "UV sensitivity" in active:
-            uv = rec.get("uvi",2); risk += 3 if uv>=7 else (2 if uv>=4 else 1)
-        if "Pollen sensitivity" in active or "Breathing sensitivity" in active:
-            if 5<=h<=10 or 16<=h<=20: risk += 2
-            else: risk += 1
-            if rec.get("rain"): risk -= 1
-        risks.append(max(0,risk))
-    good_mask = [r<=2 for r in risks]
-    idx = contiguous_windows([rec["time"] for rec in hourly], good_mask)
-    windows=[]
-    for s,e in idx:
-        start = hourly[s]["time"]; end = hourly[e]["time"] + timedelta(hours=1)
-        why=[]
-        if "UV sensitivity" in active: why.append("lower UV")
-        if "Pollen sensitivity" in active or "Breathing sensitivity" in active:
-            tag = "lower pollen (est.)"
-            if any(hourly[i].get("rain") for i in range(s,e+1)): tag += " after rain"
-            why.append(tag)
-        windows.append((start,end,", ".join(why) if why else "comfortable"))
-    if not windows:
-        tz = pytz.timezone(weather_ctx["tzname"]); today = hourly[0]["time"].date()
-        s1 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=6))
-        e1 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=9))
-        s2 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=18))
-        e2 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=21))
-        windows=[(s1,e1,"early morning (heuristic)"),(s2,e2,"evening (heuristic)")]
-    return windows
+    for i, s, e, r in zip(day[keep].tolist(), start[keep].tolist(), end[keep].tolist(), rained[keep].tolist()):
+        out[i].append((hourly[s]["time"], hourly[e]["time"] + timedelta(hours=1), "indoors" if indoor[i] else _window_why(active, r)))
+    return out
+
+def _fallback_windows(weather_ctx):
+    tz = pytz.timezone(weather_ctx["tzname"]); today = weather_ctx["hourly"][0]["time"].date()
+    s1 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=6))
+    e1 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=9))
+    s2 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=18))
+    e2 = tz.localize(datetime.combine(today, datetime.min.time()) + timedelta(hours=21))
+    return [(s1,e1,"early morning (heuristic)"),(s2,e2,"evening (heuristic)")]
 
 def format_window_str(windows):
     return "; ".join(f"{pretty_time(s)}–{pretty_time(e)} ({why})" for s,e,why in windows[:3])
@@ -916,6 +2306,42 @@ def _store_results(features_df, center_lat, center_lon, tzname, loc_display=None
 def _load_results():
     return st.session_state.get("results", {"features": [], "center": None, "tz": "UTC", "loc_display": None, "windows_text": None, "weather_notes": []})
 
+# Cold start: built-in locations render instantly; anything else (a signed-in user's last searched
+# address) is geocoded in the background while the default location is shown
+DEFAULT_ADDRESS = "Portland, ME"
+PRECOMPUTED_LOCATIONS = {
+    normalize_geocode_query(DEFAULT_ADDRESS): {"lat": 43.661, "lon": -70.255, "display_name": "Portland, ME", "tz": "America/New_York"},
+}
+
+def _resolve_location(address):
+    loc = geocode_address(address.strip())
+    if not loc: return None
+    return {**loc, "tz": guess_timezone(loc["lat"], loc["lon"])}
+
+def _cold_start(address):
+    loc = PRECOMPUTED_LOCATIONS.get(normalize_geocode_query(address))
+    if loc is None:
+        st.session_state["_cold_geocode"] = submit_io(_resolve_location, address)
+        loc = PRECOMPUTED_LOCATIONS[normalize_geocode_query(DEFAULT_ADDRESS)]
+    _store_results(pd.DataFrame([]), loc["lat"], loc["lon"], loc["tz"], loc_display=loc["display_name"], windows_text=None, notes=[])
+
+def _apply_deferred_location():
+    fut = st.session_state.get("_cold_geocode")
+    if fut is None or not fut.done(): return
+    st.session_state.pop("_cold_geocode", None)
+    try: loc = fut.result()
+    except Exception: loc = None
+    bundle = _load_results()
+    if loc and not bundle.get("features"):
+        _store_results(pd.DataFrame([]), loc["lat"], loc["lon"], loc["tz"], loc_display=loc.get("display_name"), windows_text=None, notes=[])
+
+@st.fragment(run_every=0.5)
+def _await_cold_geocode():
+    # Polls the background geocode and reruns the page once it lands, so the map moves without user input
+    fut = st.session_state.get("_cold_geocode")
+    if fut is not None and fut.done():
+        safe_rerun()
+
 # =========================
 # EXPLORE PAGE (compact filters + aligned list/map)
 # =========================
@@ -924,24 +2350,24 @@ def page_explore():
 
     default_sens = []
     default_inc = set()
-    if st.session_state.user_id:
-        me = get_user(st.session_state.user_id)
-        try: default_sens = json.loads(me.get("sensitivities") or "[]")
-        except Exception: default_sens = []
-        try: default_inc = set(json.loads(me.get("activities") or "[]"))
-        except Exception: default_inc = set()
-    else:
-        me = None
+    me = current_user() if st.session_state.user_id else None
+    if me:
+        default_sens = list(me["sensitivities"])
+        default_inc = set(me["activity_set"])
 
     # ======== COMPACT FILTER BAR ========
     st.markdown('<div class="hp-card hp-compact">', unsafe_allow_html=True)
-    c1, c2, c3 = st.columns([4, 1.6, 1])
+    c1, c2, c_day, c3 = st.columns([4, 1.6, 1.2, 1])
     with c1:
-        address = st.text_input("Where?", value=st.session_state.get("last_address", "Portland, ME"), placeholder="City / address / ZIP")
+        default_address = st.session_state.get("last_address") or (me or {}).get("last_address") or DEFAULT_ADDRESS
+        address = st.text_input("Where?", value=default_address, placeholder="City / address / ZIP")
     with c2:
         if "radius_km" not in st.session_state: st.session_state["radius_km"] = 10
         radius_km = st.slider("Radius (km)", 2, 30, int(st.session_state["radius_km"]), 1)
         st.session_state["radius_km"] = radius_km
+    with c_day:
+        day_offset = st.selectbox("When", list(range(FORECAST_DAYS)), key="day_offset",
+                                  format_func=lambda d: "Today" if d == 0 else ("Tomorrow" if d == 1 else (datetime.now() + timedelta(days=d)).strftime("%A")))
     with c3:
         go = st.button("Search", type="primary", use_container_width=True)
 
@@ -991,11 +2417,14 @@ def page_explore():
 
     if go:
         st.session_state["last_address"] = address
+        st.session_state.pop("_cold_geocode", None)
         need_fresh_results = True
     elif "results" not in st.session_state:
-        base_loc = geocode_address(address.strip()) or {"lat": 43.661, "lon": -70.255, "display_name":"Portland, ME"}
-        _store_results(pd.DataFrame([]), base_loc["lat"], base_loc["lon"], guess_timezone(base_loc["lat"], base_loc["lon"]),
-                       loc_display=base_loc.get("display_name"), windows_text=None, notes=[])
+        _cold_start(address)
+    else:
+        _apply_deferred_location()
+    if "_cold_geocode" in st.session_state:
+        _await_cold_geocode()
 
     if need_fresh_results:
         if not address.strip():
@@ -1006,36 +2435,33 @@ def page_explore():
             st.error("Couldn't geocode that location. Try a nearby city or ZIP.")
             return
         lat, lon = loc["lat"], loc["lon"]
+        if me and me.get("last_address") != address.strip():
+            save_last_address(me["id"], address.strip())
+            me["last_address"] = address.strip()  # keep the session's cached profile in step
         tzname = guess_timezone(lat, lon)
         keys = load_optional_keys()
 
-        weather_ctx = fetch_weather_context(lat, lon, tzname, keys)
+        weather_ctx = fetch_weather_context(lat, lon, tzname, keys, day_offset)
         windows = build_time_windows(weather_ctx, set(sensitivities))
         windows_text = format_window_str(windows)
+        if day_offset:
+            windows_text = f"{windows[0][0].strftime('%a %b %d')}: {windows_text}"
         weather_notes = weather_ctx.get("notes") or []
 
         with st.spinner("Querying OpenStreetMap for places..."):
-            places = fetch_places(lat, lon, radius_km)
-            roads  = fetch_roads(lat, lon, radius_km)
+            places, roads_idx = fetch_area(lat, lon, radius_km)
 
         if places.empty:
             _store_results(pd.DataFrame([]), lat, lon, tzname, loc_display=loc["display_name"],
                            windows_text=windows_text, notes=weather_notes)
             st.warning("No public activity places found within that radius. Try enlarging the search.")
         else:
-            def nearest_road_m(latp, lonp):
-                if roads is None or roads.empty: return None
-                dmins = [haversine_km(latp, lonp, rlat, rlon)*1000 for rlat, rlon in zip(roads["lat"].values, roads["lon"].values)]
-                return min(dmins) if dmins else None
-            places["road_distance_m"] = places.apply(lambda r: nearest_road_m(r["lat"], r["lon"]), axis=1)
+            road_m = roads_idx.nearest_m(places["lat"].values, places["lon"].values)
+            places["road_distance_m"] = [None if np.isnan(d) else float(d) for d in road_m]
 
             active = set(sensitivities)
-            feats = []
-            for _, row in places.iterrows():
-                cls = classify_feature(row)
-                score = score_feature(cls, active, row["distance_km"], row["road_distance_m"])
-                feats.append({**row.to_dict(), **cls, "score": score})
-            features = pd.DataFrame(feats)
+            features = pd.concat([places, classify_frame(places)], axis=1)
+            features["score"] = score_frame(features, active)
 
             def _match_sets(activity_set: set[str], inc: set[str], exc: set[str]) -> bool:
                 if activity_set & exc: return False
@@ -1049,13 +2475,9 @@ def page_explore():
             if st.session_state.get("q_away"):        features = features[features["road_distance_m"].fillna(1e9) > 350]
             elif st.session_state.get("q_near"):      features = features[features["road_distance_m"].fillna(0) < 120]
 
-            def _soft_pref_bump(row):
-                bump = 0
-                if st.session_state.get("q_shaded") and row.get("shaded_possible"): bump += 3
-                if st.session_state.get("q_paved") and row.get("paved"): bump += 3
-                return row["score"] + bump
             if not features.empty:
-                features["score"] = features.apply(_soft_pref_bump, axis=1)
+                if st.session_state.get("q_shaded"): features["score"] = features["score"] + 3*features["shaded_possible"].astype(bool)
+                if st.session_state.get("q_paved"):  features["score"] = features["score"] + 3*features["paved"].astype(bool)
 
             TOP_N = 30
             if features.empty:
@@ -1065,6 +2487,7 @@ def page_explore():
             else:
                 features = features.sort_values(["score","distance_km"], ascending=[False, True]).reset_index(drop=True).head(TOP_N)
                 features["rank"] = features.index + 1
+                features["best_windows"] = [format_window_str(w) for w in place_windows(features, weather_ctx, active)]
                 _store_results(features, lat, lon, tzname, loc_display=loc["display_name"],
                                windows_text=windows_text, notes=weather_notes)
 
@@ -1127,6 +2550,8 @@ def page_explore():
                     safe_rerun()
                 st.markdown('</div>', unsafe_allow_html=True)
                 st.caption(f"{r['kind']} • {r['distance_km']:.2f} km • Score {r['score']:.0f}")
+                if r.get("best_windows"):
+                    st.caption(f"Best times: {r['best_windows']}")
 
                 chips=[]
                 if r["indoor"]: chips.append('<span class="hp-chip">indoor</span>')
@@ -1210,13 +2635,19 @@ def render_auth_gate():
             li_pw = st.text_input("Password", type="password")
             li_go = st.form_submit_button("Log in")
         if li_go:
-            uid = authenticate(li_user.strip(), li_pw)
-            if uid:
-                st.session_state.user_id = uid
-                st.toast("Logged in ✅", icon="✅")
-                safe_rerun()
+            try:
+                uid = authenticate(li_user.strip(), li_pw, client_ip())
+            except AuthRateLimited as e:
+                st.error(f"Too many failed attempts. Try again in {max(1, math.ceil(e.retry_after / 60))} min.")
+            except AuthBusy:
+                st.error("Sign-in is busy right now. Please try again in a moment.")
             else:
-                st.error("Invalid username or password.")
+                if uid:
+                    st.session_state.user_id = uid
+                    st.toast("Logged in ✅", icon="✅")
+                    safe_rerun()
+                else:
+                    st.error("Invalid username or password.")
         st.markdown('</div>', unsafe_allow_html=True)
 
     with colR:
@@ -1241,16 +2672,37 @@ def render_auth_gate():
                     safe_rerun()
                 except sqlite3.IntegrityError:
                     st.error("Username or email already exists.")
+                except AuthBusy:
+                    st.error("Sign-up is busy right now. Please try again in a moment.")
         st.markdown('</div>', unsafe_allow_html=True)
     return False
 
+def paged_rows(state_key, fetch, sig=None, after=None, pages=1):
+    """'Load more' over a keyset-paged fetch(after) -> (rows, next_cursor): re-reads the pages opened so
+    far by chaining cursors. The page count resets when `sig` (e.g. the search text) changes."""
+    state = st.session_state.get(state_key)
+    if not state or state["sig"] != sig:
+        state = st.session_state[state_key] = {"sig": sig, "pages": pages}
+    rows = []
+    for _ in range(state["pages"]):
+        page, after = fetch(after)
+        rows += page
+        if after is None:
+            break
+    return rows, after
+
+def load_more_button(state_key, nxt, label="Load more"):
+    if nxt is not None and st.button(label, key=f"more_{state_key}"):
+        st.session_state[state_key]["pages"] += 1
+        safe_rerun()
+
 def page_community():
     st.markdown("### 👥 Community: Groups, Outings & Posts")
 
     if not render_auth_gate():
         return
 
-    me = get_user(st.session_state.user_id)
+    me = current_user()
     top = st.columns([1,6,1])
     with top[0]:
         if st.button("← Explore"):
@@ -1260,18 +2712,27 @@ def page_community():
             st.session_state.user_id = None
             safe_rerun()
 
-    q = st.text_input("Search by city (preferred) or name", value="")
-    all_groups = list_groups(q)
-
-    memberships = {g["id"]: g for g in my_groups(me["id"]) }
-    my_cards = [g for g in all_groups if g["id"] in memberships]
-    other_cards = [g for g in all_groups if g["id"] not in memberships]
+    q = st.text_input("Search groups, outings and posts", value="", placeholder="City, name, tag or keyword")
+    if fts_match_expr(q):
+        hit_outings, hit_posts = search_outings(q, limit=10), search_posts(q, me["id"], limit=10)
+        if hit_outings or hit_posts:
+            with st.expander(f"Outings & posts matching “{q.strip()}”", expanded=True):
+                for o in hit_outings:
+                    st.markdown(f"**{o['title']}** — {o['group_name']} • {o['time_utc'][:16].replace('T', ' ')} UTC @ {o.get('location_name') or 'TBD'}")
+                    if st.button("Open group", key=f"hit_o_{o['id']}"):
+                        st.session_state["view_group_id"] = o["group_id"]; safe_rerun()
+                for p in hit_posts:
+                    st.markdown(f"💬 **{p['username']}** in {p['group_name']}: {p['body'][:160]}")
+                    if st.button("Open group", key=f"hit_p_{p['id']}"):
+                        st.session_state["view_group_id"] = p["group_id"]; safe_rerun()
+    my_cards, my_next = paged_rows("pg_groups_mine", lambda c: list_group_cards_page(me["id"], q, True, c), sig=q)
+    other_cards, other_next = paged_rows("pg_groups_other", lambda c: list_group_cards_page(me["id"], q, False, c), sig=q)
 
     def render_group_card(gdict):
         st.markdown('<div class="hp-card">', unsafe_allow_html=True)
         gid = gdict["id"]
         tags = ", ".join(json.loads(gdict.get("tags") or "[]")) or "—"
-        nxt = next_outing(gid)
+        nxt = gdict.get("next_outing")
         if nxt:
             try:
                 loc = nxt.get("location_name") or "TBD"
@@ -1283,7 +2744,7 @@ def page_community():
             nxt_txt = "Next outing: —"
 
         st.markdown(f"### {gdict['name']}")
-        st.caption(f"City: {gdict.get('city') or '—'} • Owner: {gdict['owner_name']} • Tags: {tags}")
+        st.caption(f"City: {gdict.get('city') or '—'} • Owner: {gdict['owner_name']} • Members: {gdict.get('member_count', 0)} • Tags: {tags}")
         st.caption(nxt_txt)
         c1, c2, c3, _ = st.columns(4)
         with c1:
@@ -1291,7 +2752,7 @@ def page_community():
                 st.session_state["view_group_id"] = gid
                 safe_rerun()
         with c2:
-            if not is_member(gid, me["id"]):
+            if not gdict["is_member"]:
                 if st.button("Join", key=f"join_g_{gid}"):
                     join_group(gid, me["id"])
                     st.toast("Joined group", icon="✅")
@@ -1321,18 +2782,20 @@ def page_community():
         st.info("You haven't joined any groups yet.")
     else:
         cols = st.columns(2)
-        for i, g in enumerate(my_cards[:50]):
+        for i, g in enumerate(my_cards):
             with cols[i % 2]:
                 render_group_card(g)
+        load_more_button("pg_groups_mine", my_next, "More of your groups")
 
     st.markdown("#### All groups")
     if not other_cards:
         st.info("No other groups found.")
     else:
         cols = st.columns(2)
-        for i, g in enumerate(other_cards[:100]):
+        for i, g in enumerate(other_cards):
             with cols[i % 2]:
                 render_group_card(g)
+        load_more_button("pg_groups_other", other_next, "More groups")
 
     st.markdown("#### Create a new group")
     with st.form("new_group"):
@@ -1370,13 +2833,11 @@ def page_community():
     cols = st.columns([2,2])
     with cols[0]:
         st.markdown("#### Outings")
-        outings = list_outings(g["id"])
-        if not outings:
-            st.info("No outings yet. Be the first to create one!")
-        else:
-            for o in outings:
+        def render_outings(outings):
+            outing_tz = guess_timezones([(o["lat"], o["lon"]) if (o.get("lat") and o.get("lon")) else None for o in outings])
+            for o, tzn in zip(outings, outing_tz):
                 st.markdown('<div class="hp-card">', unsafe_allow_html=True)
-                local_tz = pytz.timezone(guess_timezone(o["lat"], o["lon"])) if (o.get("lat") and o.get("lon")) else pytz.timezone("UTC")
+                local_tz = pytz.timezone(tzn or "UTC")
                 try:
                     dt = datetime.fromisoformat(o["time_utc"]).astimezone(local_tz)
                     dt_str = dt.strftime('%b %d, %Y %I:%M %p %Z')
@@ -1385,8 +2846,7 @@ def page_community():
                 st.markdown(f"**{o['title']}** — {dt_str}")
                 st.caption(f"Where: {o.get('location_name') or 'TBD'} • Host: {o['creator']} • Max: {o.get('max_people') or '—'}")
                 if o.get("notes"): st.write(o["notes"])
-                counts = rsvp_counts(o["id"])
-                st.caption(f"RSVPs — going: {counts.get('going',0)}, maybe: {counts.get('maybe',0)}, not going: {counts.get('not_going',0)}")
+                st.caption(f"RSVPs — going: {o.get('going_count',0)}, maybe: {o.get('maybe_count',0)}, not going: {o.get('not_going_count',0)}")
                 if mem:
                     b1, b2, b3 = st.columns(3)
                     with b1:
@@ -1402,6 +2862,20 @@ def page_community():
                     st.caption("Join this group to RSVP.")
                 st.markdown('</div>', unsafe_allow_html=True)
 
+        upcoming, upcoming_next = paged_rows(f"pg_outings_{g['id']}", lambda c: list_outings_page(g["id"], c))
+        if not upcoming:
+            st.info("No upcoming outings. Be the first to create one!")
+        else:
+            render_outings(upcoming)
+            load_more_button(f"pg_outings_{g['id']}", upcoming_next, "More outings")
+        if st.toggle("Show past outings", key=f"past_outings_{g['id']}"):
+            past, past_next = paged_rows(f"pg_past_outings_{g['id']}", lambda c: list_outings_page(g["id"], c, upcoming=False))
+            if not past:
+                st.caption("No past outings.")
+            else:
+                render_outings(past)
+                load_more_button(f"pg_past_outings_{g['id']}", past_next, "Older outings")
+
     with cols[1]:
         st.markdown("#### Create outing")
         if not mem:
@@ -1447,19 +2921,32 @@ def page_community():
             st.toast("Posted!", icon="✅")
             safe_rerun()
 
-        posts = list_posts(g["id"])
+        posts, posts_next = paged_rows(f"pg_posts_{g['id']}", lambda c: list_posts_page(g["id"], c))
         if not posts:
             st.caption("No posts yet.")
         else:
+            # Threads start collapsed: counts for every post, first page of bodies only for the expanded ones
+            n_comments = comment_counts([p["id"] for p in posts])
+            open_ids = [p["id"] for p in posts if n_comments.get(p["id"]) and st.session_state.get(f"thread_{p['id']}")]
+            threads = list_comments_for_posts(open_ids, COMMENTS_PAGE_SIZE) if open_ids else {}
             for p in posts:
                 st.markdown('<div class="hp-card">', unsafe_allow_html=True)
                 st.markdown(f"**{p['username']}** — _{p['created_at']}_")
                 st.write(p["body"])
-                cmts = list_comments(p["id"])
-                if cmts:
+                n = n_comments.get(p["id"], 0)
+                if n:
+                    st.toggle(f"{n} repl{'y' if n == 1 else 'ies'}", key=f"thread_{p['id']}")
+                    cmts = threads.get(p["id"], [])
+                    if cmts and n > len(cmts):
+                        more, cmts_next = paged_rows(f"pg_cmts_{p['id']}", lambda c, pid=p["id"]: list_comments_page(pid, c),
+                                                     after=(cmts[-1]["created_at"], cmts[-1]["id"]), pages=0)
+                        cmts = cmts + more
+                    else:
+                        cmts_next = None
                     for c in cmts:
                         st.caption(f"↳ {c['username']} — {c['created_at']}")
                         st.text(c["body"])
+                    load_more_button(f"pg_cmts_{p['id']}", cmts_next, "More replies")
                 with st.form(f"cmt_{p['id']}"):
                     cbody = st.text_input("Reply", placeholder="Write a reply…")
                     cgo = st.form_submit_button("Send")
@@ -1468,6 +2955,7 @@ def page_community():
                     st.toast("Reply posted", icon="💬")
                     safe_rerun()
                 st.markdown('</div>', unsafe_allow_html=True)
+            load_more_button(f"pg_posts_{g['id']}", posts_next, "Older posts")
 
 # =========================
 # PROFILE PAGE
@@ -1476,7 +2964,7 @@ def page_profile():
     st.markdown("### 👤 My Profile")
     if not render_auth_gate():
         return
-    me = get_user(st.session_state.user_id)
+    me = current_user()
 
     top = st.columns([1,6,1])
     with top[0]:
@@ -1487,12 +2975,8 @@ def page_profile():
             st.session_state.user_id = None
             safe_rerun()
 
-    my_sens = []
-    my_acts = []
-    try: my_sens = json.loads(me.get("sensitivities") or "[]")
-    except Exception: pass
-    try: my_acts = json.loads(me.get("activities") or "[]")
-    except Exception: pass
+    my_sens = me["sensitivities"]
+    my_acts = me["activities"]
 
     with st.form("profile_form"):
         bio = st.text_area("Bio", value=me.get("bio") or "", placeholder="A bit about you...")